@@ -0,0 +1,73 @@
+import errno
+import os
+import shutil
+import threading
+
+from common import all_pitch_folders_path
+from raster import RENDITIONS, slide_paths
+
+
+def media_folder_path(pid):
+    return os.path.abspath(os.path.join("media", str(pid)))
+
+
+def link_file(src, dst):
+    """
+    hard link src to dst, replacing whatever dst currently is.
+    Falls back to a copy when the two are on different file systems.
+    """
+    # unique per writer, concurrent tasks may link the same dst
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.link"
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def link_pitch_artifacts(src_pid, dst_pid, media=True):
+    """
+    Share the derived artifacts of pitch `src_pid` with pitch `dst_pid`.
+    Slide images (all renditions) and everything under media/ (audio, video, hls) are hard linked,
+    so the second pitch costs no extra disk and no recompute. Writers must call
+    `detach_tree` on a folder before regenerating files in it (copy-on-write).
+    With media=False only the slides are linked.
+    """
+    src_pitch_folder, _ = all_pitch_folders_path(src_pid)
+    dst_pitch_folder, _ = all_pitch_folders_path(dst_pid)
+    # every rendition of every slide, whatever the raster format
+    for sub_folder, _ in RENDITIONS.values():
+        target = os.path.join(dst_pitch_folder, sub_folder)
+        os.makedirs(target, exist_ok=True)
+        for path in slide_paths(os.path.join(src_pitch_folder, sub_folder)):
+            link_file(path, os.path.join(target, os.path.basename(path)))
+
+    src_media = media_folder_path(src_pid)
+    dst_media = media_folder_path(dst_pid)
+    if not media or not os.path.isdir(src_media):
+        return
+    for root, _, files in os.walk(src_media):
+        target = os.path.join(dst_media, os.path.relpath(root, src_media))
+        os.makedirs(target, exist_ok=True)
+        for file in files:
+            link_file(os.path.join(root, file), os.path.join(target, file))
+
+
+def detach_tree(folder):
+    """
+    Drop every file in `folder` that is still shared with another pitch so that
+    regenerating it can not write through the hard link into the other pitch.
+    """
+    if not os.path.isdir(folder):
+        return
+    for root, _, files in os.walk(folder):
+        for file in files:
+            path = os.path.join(root, file)
+            if os.stat(path).st_nlink > 1:
+                os.remove(path)
@@ -1,6 +1,94 @@
+import hashlib
 import os
+import tempfile
+
+from config import MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE
+
+
+class UploadTooLarge(Exception):
+    pass
 
 
 def all_pitch_folders_path(pid):
     pitch_folder = os.path.abspath(os.path.join("uploads", str(pid)))
     return pitch_folder, os.path.join(pitch_folder, 'references')
+
+
+async def save_upload(file, folder, max_size=MAX_UPLOAD_SIZE):
+    """
+    Stream an UploadFile to `folder` in fixed size chunks.
+    Bytes go to a temp file in the destination folder while the sha256 and size are
+    computed, the temp file is renamed into place once the body is complete.
+
+    Returns:
+        (path, sha256 hex digest, size in bytes)
+    Raises:
+        UploadTooLarge: once more than max_size bytes have been received.
+    """
+    os.makedirs(folder, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".upload_", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise UploadTooLarge(f"upload exceeds {max_size} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+        upload_path = os.path.join(folder, os.path.basename(file.filename))
+        os.replace(tmp_path, upload_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return upload_path, digest.hexdigest(), size
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def touch(path):
+    """mark a cached file as recently used"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def prune_lru(folder, max_bytes):
+    """
+    Delete the least recently used files (oldest mtime first) under `folder`
+    until it holds at most max_bytes. Returns the number of bytes freed.
+    """
+    entries = []
+    total = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    freed = 0
+    for _, size, path in sorted(entries):
+        if total - freed <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            freed += size
+        except FileNotFoundError:
+            pass
+    return freed
@@ -1,2 +1,123 @@
+import os
+
 PROJECT_ID = "moonbox-auth-dev"
 LOC = "asia-southeast1"
+
+# uploads
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", 200 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+
+# pdf rasterization
+RASTER_DPI = int(os.environ.get("RASTER_DPI", 300))
+RASTER_FORMAT = os.environ.get("RASTER_FORMAT", "jpeg")  # jpeg, png
+RASTER_PAGES_PER_BATCH = int(os.environ.get("RASTER_PAGES_PER_BATCH", 1))
+# number of concurrent pdftoppm renders
+RASTER_WORKERS = int(os.environ.get("RASTER_WORKERS", os.cpu_count() or 1))
+# max pixel dimensions as WIDTHxHEIGHT, empty for no limit
+# slide sent to the vision model
+MODEL_IMAGE_SIZE = os.environ.get("MODEL_IMAGE_SIZE", "1536x1536")
+# slide used as a video frame
+VIDEO_FRAME_SIZE = os.environ.get("VIDEO_FRAME_SIZE", "1920x1080")
+
+# transcribe
+# concurrent gemini calls per deck while drafting pages
+DRAFT_CONCURRENCY = int(os.environ.get("DRAFT_CONCURRENCY", 8))
+# sequential: one page at a time, each prompt sees the previous speech
+# parallel: every page at once from the drafts, then a transition smoothing pass
+# batched: several consecutive pages per request
+TRANSCRIPT_MODE = os.environ.get("TRANSCRIPT_MODE", "sequential")
+TRANSCRIPT_CONCURRENCY = int(os.environ.get("TRANSCRIPT_CONCURRENCY", 8))
+# page transitions smoothed per request, 0 to skip the smoothing pass
+SMOOTH_BATCH_SIZE = int(os.environ.get("SMOOTH_BATCH_SIZE", 4))
+# batched: consecutive pages packed into one request within a token budget
+TRANSCRIPT_BATCH_TOKENS = int(os.environ.get("TRANSCRIPT_BATCH_TOKENS", 6000))
+TRANSCRIPT_BATCH_MAX_PAGES = int(os.environ.get("TRANSCRIPT_BATCH_MAX_PAGES", 8))
+# expected length of one page speech
+TRANSCRIPT_SPEECH_TOKENS = int(os.environ.get("TRANSCRIPT_SPEECH_TOKENS", 400))
+
+# recompile prompt files when they change on disk, for development
+PROMPTS_HOT_RELOAD = os.environ.get("PROMPTS_HOT_RELOAD", "false").lower() == "true"
+
+# text to speech
+# synthesizers kept open per voice in each worker process. Pages are synthesized
+# by one task each, their parallelism is the celery worker concurrency
+TTS_CONCURRENCY = int(os.environ.get("TTS_CONCURRENCY", 8))
+# page audio requested from the speech service: wav (pcm), mp3 or opus (ogg)
+TTS_AUDIO_FORMAT = os.environ.get("TTS_AUDIO_FORMAT", "wav")
+# content addressed page audio, least recently used entries evicted over the quota
+AUDIO_STORE_DIR = os.path.abspath(os.environ.get("AUDIO_STORE_DIR", "audio_store"))
+AUDIO_STORE_MAX_BYTES = int(
+    os.environ.get("AUDIO_STORE_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+)
+# subtitles come from the synthesis word boundaries, characters per cue
+SUBTITLE_MAX_CHARS = int(os.environ.get("SUBTITLE_MAX_CHARS", 84))
+# whisper subtitles, for page audio that was not synthesized here
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "openai/whisper-large-v3")
+# empty for cuda when available, otherwise cpu
+WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE", os.environ.get("DEVICE", ""))
+# int8 dynamic quantization of the linear layers on cpu
+WHISPER_QUANTIZE = os.environ.get("WHISPER_QUANTIZE", "true").lower() == "true"
+WHISPER_BATCH_SIZE = int(os.environ.get("WHISPER_BATCH_SIZE", 8))
+
+# video
+# slides are still images, a low frame rate and long gop cost nothing visually
+VIDEO_FPS = int(os.environ.get("VIDEO_FPS", 1))
+VIDEO_GOP_SECONDS = int(os.environ.get("VIDEO_GOP_SECONDS", 10))
+VIDEO_CRF = int(os.environ.get("VIDEO_CRF", 23))
+VIDEO_PRESET = os.environ.get("VIDEO_PRESET", "veryfast")
+VIDEO_AUDIO_BITRATE = os.environ.get("VIDEO_AUDIO_BITRATE", "128k")
+# slides encoded at the same time by build_hls / encode_segments, each by its own
+# ffmpeg. The celery canvas encodes as many as the worker concurrency instead
+VIDEO_WORKERS = int(os.environ.get("VIDEO_WORKERS", os.cpu_count() or 1))
+VIDEO_HLS_SEGMENT_SECONDS = int(os.environ.get("VIDEO_HLS_SEGMENT_SECONDS", 10))
+# hls ladder as name:WIDTHxHEIGHT:video bitrate:audio bitrate, comma separated.
+# Slides barely move, two renditions at low bitrates play as well as a full ladder
+HLS_RENDITIONS = os.environ.get(
+    "HLS_RENDITIONS", "1080p:1920x1080:1500k:128k,540p:960x540:400k:64k"
+)
+# encoded slide segments by content, least recently used evicted over the quota
+SEGMENT_STORE_DIR = os.path.abspath(
+    os.environ.get("SEGMENT_STORE_DIR", "segment_store")
+)
+SEGMENT_STORE_MAX_BYTES = int(
+    os.environ.get("SEGMENT_STORE_MAX_BYTES", 4 * 1024 * 1024 * 1024)
+)
+
+# reference documents
+# chunks embedded and added to the vector db per call
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 32))
+# chunk size in tokens (keywords included) and tokens shared by consecutive chunks
+RAG_CHUNK_TOKENS = int(os.environ.get("RAG_CHUNK_TOKENS", 300))
+RAG_CHUNK_OVERLAP = int(os.environ.get("RAG_CHUNK_OVERLAP", 50))
+# seconds a pitch vector index stays locked by an embed or gc task (expires
+# if the worker dies), and seconds an embed task waits before trying again
+VECTOR_INDEX_LOCK_TIMEOUT = int(os.environ.get("VECTOR_INDEX_LOCK_TIMEOUT", 3600))
+VECTOR_INDEX_LOCK_RETRY = int(os.environ.get("VECTOR_INDEX_LOCK_RETRY", 30))
+
+# model response cache
+# disk, redis or none
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "disk")
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", "response_cache")
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 30 * 24 * 3600))
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.environ.get("RESPONSE_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 100000))
+
+# outbound model call budgets shared by every worker, 0 for no limit
+RATE_LIMITS = {
+    "gemini": {
+        "rpm": int(os.environ.get("GEMINI_RPM", 60)),
+        "tpm": int(os.environ.get("GEMINI_TPM", 0)),
+    },
+    "azure_openai": {
+        "rpm": int(os.environ.get("AZURE_OPENAI_RPM", 60)),
+        "tpm": int(os.environ.get("AZURE_OPENAI_TPM", 40000)),
+    },
+    "azure_speech": {
+        "rpm": int(os.environ.get("AZURE_SPEECH_RPM", 200)),
+        "tpm": 0,
+    },
+}
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get("RATE_LIMIT_MAX_RETRIES", 5))
+RATE_LIMIT_MAX_DELAY = float(os.environ.get("RATE_LIMIT_MAX_DELAY", 60))
@@ -1,17 +1,29 @@
 import json
 import os
+import shutil
 import uuid
 from typing import Any, List, Annotated
 from fastapi import FastAPI, HTTPException, UploadFile, Form, Request
 from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers
 from llm import get_remote_chat_response
 
 import orm
 import rag
 import cache
-from common import all_pitch_folders_path
-from tasks import transcribe, resume, ssml_audio_sync
+import artifacts
+from common import all_pitch_folders_path, save_upload, UploadTooLarge
+from config import MAX_UPLOAD_SIZE, VECTOR_INDEX_LOCK_TIMEOUT
+from schema import PageDraft, PageEdit
+from tasks import (
+    transcribe,
+    resume,
+    ssml_audio_sync,
+    embed_reference,
+    vector_index_lock,
+)
+from transcribe import regenerate_pages, speech_input_hashes
 
 app = FastAPI()
 
@@ -33,6 +45,47 @@ orm.init_db()
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
+class UploadSizeLimit:
+    """
+    Reject request bodies over `max_size` bytes before the multipart parser
+    spools them: up front from Content-Length, and while the body streams in
+    for chunked uploads that send none.
+    """
+
+    def __init__(self, app, max_size=MAX_UPLOAD_SIZE):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.max_size:
+            await self.app(scope, receive, send)
+            return
+        detail = f"Upload exceeds {self.max_size} bytes"
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit():
+            if int(content_length) > self.max_size:
+                response = JSONResponse({"detail": detail}, status_code=413)
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    # surfaces through the body parser as the route's response
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(UploadSizeLimit, max_size=MAX_UPLOAD_SIZE)
+
+
 # --------------web api routes----------------
 @app.get("/")
 async def ping():
@@ -48,11 +101,10 @@ async def upload_master(request: Request, file: UploadFile):
 
     pitch_folder, references_folder = all_pitch_folders_path(pitch.id)
 
-    os.makedirs(pitch_folder, exist_ok=True)
-    source_stream = await file.read()
-    upload_path = os.path.join(pitch_folder, file.filename)
-    with open(upload_path, "wb") as f:
-        f.write(source_stream)
+    try:
+        upload_path, content_hash, _ = await save_upload(file, pitch_folder)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
     os.makedirs(references_folder, exist_ok=True)
     master_doc = orm.Document(
@@ -60,9 +112,16 @@ async def upload_master(request: Request, file: UploadFile):
         master_doc=True,
         file_name=file.filename,
         storage_path=upload_path,
+        content_hash=content_hash,
     )
     master_doc.save()
 
+    # same deck transcribed before, share its artifacts instead of recomputing
+    source_doc = orm.Document.get_transcribed_master_by_hash(content_hash)
+    if source_doc and source_doc.id != master_doc.id:
+        task_id = link_transcribed_pitch(pitch, master_doc, source_doc)
+        return JSONResponse({"pitch_uid": uid, "task_id": task_id, "message": None})
+
     task_id = str(uuid.uuid4())
     orm.Task.create_task(
         pitch_id=pitch.id,
@@ -100,6 +159,63 @@ async def upload_master(request: Request, file: UploadFile):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def source_audio_task(source_pitch_id):
+    """
+    The finished audio task of a pitch whose media can be shared, None while
+    its newest audio run failed or another one is rendering the media folder.
+    """
+    latest = orm.Task.get_latest_tts_by_pitch_id(source_pitch_id)
+    if not latest or latest.process_stage != orm.AudioStage.FINISH.value:
+        return None
+    if orm.Task.get_running_tts_by_pitch_id(source_pitch_id):
+        return None
+    return latest
+
+
+def link_transcribed_pitch(pitch, master_doc, source_doc):
+    source_pitch = orm.Pitch.get_by_pitch_id(source_doc.pitch_id)
+    artifacts.link_file(source_doc.storage_path, master_doc.storage_path)
+    source_tts = source_audio_task(source_pitch.id)
+    artifacts.link_pitch_artifacts(
+        source_pitch.id, pitch.id, media=source_tts is not None
+    )
+    if source_tts:
+        # a render that started while linking may have left only part of it
+        current = source_audio_task(source_pitch.id)
+        if not current or current.id != source_tts.id:
+            shutil.rmtree(artifacts.media_folder_path(pitch.id), ignore_errors=True)
+            source_tts = None
+
+    # drafts and transcript are copied by value, edits stay local to this pitch
+    pitch.drafts = source_pitch.drafts
+    pitch.transcript = source_pitch.transcript
+    pitch.speech_inputs = source_pitch.speech_inputs
+    pitch.save()
+
+    master_doc.progress = source_doc.progress
+    master_doc.processed = 1
+    master_doc.save()
+
+    task_id = str(uuid.uuid4())
+    orm.Task.create_task(
+        pitch_id=pitch.id,
+        task_id=task_id,
+        task_type=0,
+        process_stage=orm.TranscribeStage.FINISH.value,
+        version=0,
+        doc_id=master_doc.id,
+    )
+    if source_tts:
+        orm.Task.create_task(
+            pitch_id=pitch.id,
+            task_id=str(uuid.uuid4()),
+            task_type=1,
+            process_stage=orm.AudioStage.FINISH.value,
+            version=0,
+        )
+    return task_id
+
+
 @app.get("/{pitch_uid}/master_doc")
 def serving_master_doc(pitch_uid: str):
     pitch = orm.Pitch.get_by_pitch_uid(pitch_uid=pitch_uid)
@@ -138,12 +254,12 @@ async def upload_embedding(
     if not pitch:
         raise HTTPException(status_code=404, detail="Pitch not found")
 
-    source_stream = await file.read()
     # upload file to uploads folder
-    _, ref_folder = all_pitch_folders_path(pitch_uid)
-    upload_path = os.path.join(ref_folder, file.filename)
-    with open(upload_path, "wb") as f:
-        f.write(source_stream)
+    _, ref_folder = all_pitch_folders_path(pitch.id)
+    try:
+        upload_path, _, _ = await save_upload(file, ref_folder)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
     # create document
     document = orm.Document(
@@ -160,16 +276,43 @@ async def upload_embedding(
         pitch_id=pitch.id,
         task_id=task_id,
         task_type=2,
-        process_stage=0,
+        process_stage=orm.EmbeddingStage.PROCESSING.value,
         version=0,
         doc_id=document.id,
     )
-    try:
-        rag.load_and_embed(pitch.id, upload_path, keywords.split(","))
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # parsing and embedding run in the worker, not on the event loop
+    task_resp = embed_reference.delay(
+        {
+            "task_id": task_id,
+            "doc_id": document.id,
+        }
+    )
+    if not task_resp.id:
+        raise HTTPException(status_code=404, detail="Task not found")
 
-    return {"message": None}
+    return {
+        "task_id": task_id,
+        "doc_id": document.id,
+        "status": orm.EmbeddingStage.PROCESSING.value,
+        "message": None,
+    }
+
+
+@app.get("/{pitch_uid}/reference_doc/{doc_id}/status")
+def reference_doc_status(pitch_uid: str, doc_id: int):
+    pitch = orm.Pitch.get_by_pitch_uid(pitch_uid=pitch_uid)
+    if not pitch:
+        raise HTTPException(status_code=404, detail="Pitch not found")
+    document = orm.Document.get_by_doc_id(doc_id=doc_id)
+    task = orm.Task.get_embedding_task_by_doc_id(document_id=doc_id)
+    if not document or not task or document.pitch_id != pitch.id:
+        raise HTTPException(status_code=404, detail="Embedding task not found")
+    return {
+        "task_id": task.task_id,
+        "status": task.process_stage,
+        "progress": document.progress,
+        "message": None,
+    }
 
 
 @app.get("/{pitch_uid}/reference_doc")
@@ -208,7 +351,24 @@ async def remove_reference_doc(pitch_uid: str, doc_id: int):
     pitch = orm.Pitch.get_by_pitch_uid(pitch_uid=pitch_uid)
     if not pitch:
         raise HTTPException(status_code=404, detail="Pitch not found")
-    if orm.Document.remove_by_doc_id(pitch_id=pitch.id):
+    doc = orm.Document.get_by_doc_id(doc_id=doc_id)
+    if not doc or doc.pitch_id != pitch.id or doc.master_doc:
+        raise HTTPException(status_code=404, detail="Doc not found")
+    # an embed or gc of the same pitch would copy the deleted vectors back
+    lock_id = vector_index_lock(pitch.id)
+    if not cache.acquire_lock(lock_id, lock_timeout=VECTOR_INDEX_LOCK_TIMEOUT):
+        raise HTTPException(
+            status_code=409, detail="Reference index is being updated, retry later"
+        )
+    # vectors first, a failure leaves the row so the delete can be retried
+    try:
+        rag.restore_collection(pitch.id)
+        rag.remove_document(pitch.id, doc_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        cache.release_lock(lock_id)
+    if orm.Document.remove_by_doc_id(doc_id=doc_id):
         return {"message": None}
 
     raise HTTPException(status_code=500, detail="Failed to remove reference doc")
@@ -319,12 +479,74 @@ def update_transcript(pitch_uid: str, transcripts: List[Any]):
         pitch.transcript = json.dumps(
             transcripts, default=str, ensure_ascii=False
         )  # default=str helps avoid serialization errors
+        # the stored speeches are the reference for later page regenerations
+        drafts = (
+            [PageDraft(**draft) for draft in json.loads(pitch.drafts)]
+            if pitch.drafts
+            else []
+        )
+        if drafts and len(drafts) == len(transcripts):
+            pitch.speech_inputs = json.dumps(
+                speech_input_hashes(drafts, json.loads(pitch.transcript))
+            )
+        else:
+            pitch.speech_inputs = None
         pitch.save()
     except Exception as e:  # Catch any unexpected errors
         raise HTTPException(status_code=500, detail=str(e))
     return {"message": "Transcript updated successfully"}  # More informative message
 
 
+@app.put("/{pitch_uid}/transcript/{page}")
+def update_page_transcript(pitch_uid: str, page: int, edit: PageEdit):
+    pitch = orm.Pitch.get_by_pitch_uid(pitch_uid=pitch_uid)
+    if not pitch:
+        raise HTTPException(status_code=404, detail="Pitch not found")
+    if not pitch.drafts or not pitch.transcript:
+        raise HTTPException(status_code=404, detail="Transcript not found")
+    drafts = [PageDraft(**draft) for draft in json.loads(pitch.drafts)]
+    speeches = json.loads(pitch.transcript)
+    if len(speeches) != len(drafts):
+        raise HTTPException(status_code=409, detail="Transcript not finished")
+    if page < 1 or page > len(drafts):
+        raise HTTPException(status_code=404, detail="Page not found")
+
+    i = page - 1
+    hashes = json.loads(pitch.speech_inputs) if pitch.speech_inputs else []
+    hashes += [None] * (len(drafts) - len(hashes))
+    # pitches transcribed before input hashes were recorded: the current
+    # speeches are taken as generated from the current inputs
+    if None in hashes:
+        current = speech_input_hashes(drafts, speeches)
+        hashes = [h if h is not None else current[n] for n, h in enumerate(hashes)]
+    if edit.draft is not None:
+        drafts[i].draft = edit.draft
+    pages = [i]
+    if edit.speech is not None:
+        # a speech written by the user is kept as is
+        speeches[i] = edit.speech
+        hashes[i] = speech_input_hashes(drafts, speeches)[i]
+        pages = []
+    if edit.neighbours:
+        pages += [i - 1, i + 1]
+
+    try:
+        speeches, hashes, regenerated = regenerate_pages(
+            drafts, speeches, hashes, pages
+        )
+        pitch.drafts = json.dumps([draft.dict() for draft in drafts])
+        pitch.transcript = json.dumps(speeches, ensure_ascii=False)
+        pitch.speech_inputs = json.dumps(hashes)
+        pitch.save()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "transcripts": speeches,
+        "regenerated": [index + 1 for index in regenerated],
+        "message": None,
+    }
+
+
 @app.get("/pitch_video/{pitch_uid}/{file_name}")
 def deliver_hls(pitch_uid: str, file_name: str):
     pitch = orm.Pitch.get_by_pitch_uid(pitch_uid=pitch_uid)
@@ -367,7 +589,10 @@ async def conversation(pitch_uid: str, request: Request):
     # send message to GPT3
     # request vector db and llm
     # repose should have context bound result with reference url
-    context_message = rag.retrieve_context(query, k=10, filters={"pitch_id": pitch.id})
+    # half of what construct_prompt leaves for messages and context
+    context_message = rag.retrieve_context(
+        query, k=10, filters={"pitch_id": pitch.id}, max_tokens=1000
+    )
     if not context_message:
         context_message = {"role": "user", "content": "No context found"}
     prompt = rag.construct_prompt(messages, context_message, context_window=3000)
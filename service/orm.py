@@ -11,6 +11,7 @@ from sqlalchemy import (
     Integer,
     String,
     create_engine,
+    inspect,
     text,
 )
 from sqlalchemy.ext.declarative import declarative_base
@@ -37,9 +38,31 @@ print(DATABASE_URL)
 engine = create_engine(DATABASE_URL, echo=False)
 
 
+def add_column_if_missing(table, column, ddl_type, index=None):
+    """
+    create_all never alters existing tables, columns added to a model after a
+    database was created are added here. Safe to run on every start.
+    """
+    inspector = inspect(engine)
+    if table not in inspector.get_table_names():
+        return
+    if column not in {c["name"] for c in inspector.get_columns(table)}:
+        with engine.begin() as connection:
+            connection.execute(
+                text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type} NULL")
+            )
+    if index and index not in {i["name"] for i in inspector.get_indexes(table)}:
+        with engine.begin() as connection:
+            connection.execute(text(f"CREATE INDEX {index} ON {table} ({column})"))
+
+
 def init_db():
     global Base
     Base.metadata.create_all(bind=engine)
+    add_column_if_missing(
+        "documents", "content_hash", "VARCHAR(64)", index="ix_documents_content_hash"
+    )
+    add_column_if_missing("pitches", "speech_inputs", "TEXT")
 
 
 # Session factory
@@ -81,6 +104,13 @@ class AudioStage(Enum):
     FAILED = 199
 
 
+class EmbeddingStage(Enum):
+    PROCESSING = 201
+    EMBEDDING = 202
+    FINISH = 203
+    FAILED = 299
+
+
 # Models
 class Task(Base):
     __tablename__ = "tasks"
@@ -157,6 +187,22 @@ class Task(Base):
                 session.rollback()
                 print(f"Error occurred: {e}")
 
+    @classmethod
+    def get_latest_tts_by_pitch_id(cls, pitch_id):
+        """the most recent audio task of a pitch, earlier runs may have failed"""
+        with local_session() as session:
+            try:
+                return (
+                    session.query(cls)
+                    .filter_by(pitch_id=pitch_id)
+                    .filter_by(task_type=1)
+                    .order_by(cls.id.desc())
+                    .first()
+                )
+            except Exception as e:
+                session.rollback()
+                print(f"Error occurred: {e}")
+
     @classmethod
     def get_running_tts_by_pitch_id(cls, pitch_id):
         with local_session() as session:
@@ -222,6 +268,8 @@ class Pitch(Base):
     pitch_uid = Column(VARCHAR(37), nullable=False, unique=True)
     drafts = Column(String, nullable=True)
     transcript = Column(String, nullable=True)
+    # input hash of every page speech when it was generated
+    speech_inputs = Column(String, nullable=True)
     published = Column(Boolean, nullable=False, default=False)
 
     def save(self):
@@ -275,6 +323,7 @@ class Document(Base):
     progress = Column(VARCHAR(25), nullable=False, default="0:0")
     processed = Column(Integer, nullable=False, default=0)  # 0, 1
     keywords = Column(String, nullable=True)
+    content_hash = Column(VARCHAR(64), nullable=True, index=True)  # sha256
 
     def save(self):
         with local_session() as session:
@@ -334,3 +383,22 @@ class Document(Base):
             except Exception as e:
                 session.rollback()
                 print(f"Error occurred: {e}")
+
+    @classmethod
+    def get_transcribed_master_by_hash(cls, content_hash):
+        """master doc with the same content whose transcribe task has finished"""
+        with local_session() as session:
+            try:
+                return (
+                    session.query(cls)
+                    .join(Task, Task.document_id == cls.id)
+                    .filter(cls.master_doc.is_(True))
+                    .filter(cls.content_hash == content_hash)
+                    .filter(Task.task_type == 0)
+                    .filter(Task.process_stage == TranscribeStage.FINISH.value)
+                    .order_by(cls.id.desc())
+                    .first()
+                )
+            except Exception as e:
+                session.rollback()
+                print(f"Error occurred: {e}")
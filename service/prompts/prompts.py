@@ -1,7 +1,11 @@
 import os
+import threading
+import time
 
 import jinja2
 
+from config import PROMPTS_HOT_RELOAD
+
 CORNERSTONE_PROMPT = "This is a cover page of a document. Please describe the cornerstone idea of the document in summary. Focus on this page only."
 CORNERSTONE_PROMPT_EXAMPLE = "Example: The document outlines a set of principles and values that emphasize the importance of communication, respect, excellence, and innovation in the workplace from Netflix."
 
@@ -71,6 +75,122 @@ def parse_model_params(config):
     return config_dict
 
 
+CONFIG_SEPARATOR = "<commentblock>###</commentblock>"
+PROMPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def split_prompt(prompt_file_content):
+    """split a prompt file into (config str or None, prompt template str)"""
+    if CONFIG_SEPARATOR in prompt_file_content:
+        config, prompt_str = prompt_file_content.split(CONFIG_SEPARATOR)
+        return config, prompt_str
+    return None, prompt_file_content
+
+
+class PromptLoader(jinja2.BaseLoader):
+    """loads the prompt section of the .txt prompt files in a folder"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def get_source(self, environment, template):
+        path = os.path.join(self.folder, template)
+        if not template.endswith(".txt") or not os.path.isfile(path):
+            raise jinja2.TemplateNotFound(template)
+        mtime = os.path.getmtime(path)
+        with open(path, "r") as f:
+            _, prompt_str = split_prompt(f.read())
+        return prompt_str, path, lambda: os.path.getmtime(path) == mtime
+
+    def list_templates(self):
+        return sorted(f for f in os.listdir(self.folder) if f.endswith(".txt"))
+
+
+class PromptRegistry:
+    """
+    Every prompt file in the folder is compiled once into a jinja2 Environment
+    (with a bytecode cache shared across processes) and its config parsed up
+    front, so rendering is a dict lookup plus a render.
+    With hot_reload the file mtimes are checked on every render and changed
+    prompts are recompiled, for development.
+    """
+
+    def __init__(self, folder=PROMPT_DIR, hot_reload=PROMPTS_HOT_RELOAD):
+        self.folder = folder
+        self.hot_reload = hot_reload
+        self.env = jinja2.Environment(
+            loader=PromptLoader(folder),
+            keep_trailing_newline=True,
+            trim_blocks=True,
+            auto_reload=hot_reload,
+            bytecode_cache=jinja2.FileSystemBytecodeCache(),
+        )
+        self.templates = {}
+        self.configs = {}
+        self.mtimes = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+        for name in self.env.loader.list_templates():
+            self._load(name)
+
+    def _load(self, name):
+        path = os.path.join(self.folder, name)
+        with open(path, "r") as f:
+            config, _ = split_prompt(f.read())
+        self.mtimes[name] = os.path.getmtime(path)
+        self.configs[name] = (config, parse_model_params(config))
+        self.templates[name] = self.env.get_template(name)
+
+    def _reload_if_changed(self, name):
+        path = os.path.join(self.folder, name)
+        if not os.path.isfile(path):
+            return
+        if name not in self.mtimes or os.path.getmtime(path) != self.mtimes[name]:
+            with self.lock:
+                self._load(name)
+
+    def render(self, name, curr_input):
+        """render prompt `name`, returns (prompt, raw config str)"""
+        if self.hot_reload:
+            self._reload_if_changed(name)
+        if name not in self.templates:
+            raise Exception(f"Prompt file {name} not found")
+        start = time.perf_counter()
+        prompt = self.templates[name].render(**curr_input)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            renders, seconds = self.timings.get(name, (0, 0.0))
+            self.timings[name] = (renders + 1, seconds + elapsed)
+        return prompt.strip(), self.configs[name][0]
+
+    def model_params(self, name):
+        return self.configs[name][1]
+
+    def render_timings(self):
+        """renders and render time per prompt"""
+        with self.lock:
+            return {
+                name: {
+                    "renders": renders,
+                    "seconds": round(seconds, 6),
+                    "avg_ms": round(seconds / renders * 1000, 3),
+                }
+                for name, (renders, seconds) in self.timings.items()
+            }
+
+
+prompt_registry = None
+prompt_registry_lock = threading.Lock()
+
+
+def get_prompt_registry() -> PromptRegistry:
+    global prompt_registry
+    with prompt_registry_lock:
+        if prompt_registry is None:
+            prompt_registry = PromptRegistry()
+        return prompt_registry
+
+
 def load_prompt(curr_input, prompt_to_use):
     """
     Takes in the current input (e.g. comment that you want to classifiy) and
@@ -87,6 +207,8 @@ def load_prompt(curr_input, prompt_to_use):
     model: text-davinci-003
     temperature: 0.7
 
+    Templates are compiled once by the PromptRegistry, see get_prompt_registry.
+
     ARGS:
       curr_input: the input we want to feed in (dict(key=value))
       prompt_to_use: the path to the prompt file.
@@ -95,28 +217,4 @@ def load_prompt(curr_input, prompt_to_use):
     """
     if not isinstance(curr_input, dict):
         raise Exception(f"generate prompt takes dictionary, type {type(curr_input)}")
-    # list all txt file in prompts folder
-    print(f"prompt dir: {os.path.join(os.path.dirname(__file__))}")
-    prompt_files = os.listdir(os.path.join(os.path.dirname(__file__)))
-    print(f"prompt files: {prompt_files}. Using {prompt_to_use}")
-    for prompt_file in prompt_files:
-        if prompt_file.endswith(".txt"):
-            if prompt_file == prompt_to_use:
-                with open(
-                    f"{os.path.join(os.path.dirname(__file__))}/{prompt_file}", "r"
-                ) as f:
-                    prompt_file_content = f.read()
-                    # split into config and prompt
-                    config = None
-                    if "<commentblock>###</commentblock>" in prompt_file_content:
-                        config, prompt_str = prompt_file_content.split(
-                            "<commentblock>###</commentblock>"
-                        )
-                    else:
-                        prompt_str = prompt_file_content
-                    prompt_tmpl = jinja2.Template(
-                        prompt_str, keep_trailing_newline=True, trim_blocks=True
-                    )
-                    prompt = prompt_tmpl.render(**curr_input)
-                    return prompt.strip(), config
-    raise Exception(f"Prompt file {prompt_to_use} not found")
+    return get_prompt_registry().render(prompt_to_use, curr_input)
@@ -1,25 +1,74 @@
-import uuid
+import os
 from typing import List
 
 import tiktoken
 from langchain_community.document_loaders import PyPDFLoader
 import chromadb
 from chromadb.utils import embedding_functions
+from config import EMBED_BATCH_SIZE, RAG_CHUNK_TOKENS, RAG_CHUNK_OVERLAP
 from prompts.prompts import SYSTEM_PROMPT, CITE_PROMPT
 
 chroma_cli = None
 default_ef = None
+encoding = None
 
+CONTEXT_HEADER = "\n\n### Context ###\n"
+VEC_DB_PATH = "vec_db"
+COLLECTION_PREFIX = "pitch_collection_"
+# vectors read per call while scanning or rebuilding a collection
+SCAN_BATCH_SIZE = 1000
+# suffixes of the collections a rebuild works with before swapping names
+REBUILD_SUFFIX = "_rebuild"
+ASIDE_SUFFIX = "_old"
 
-def get_vec_collection(pitch_id):
+
+def get_chroma_client():
     global chroma_cli
     if chroma_cli is None:
-        chroma_cli = chromadb.PersistentClient(path="vec_db")
+        chroma_cli = chromadb.PersistentClient(path=VEC_DB_PATH)
         if not chroma_cli.heartbeat():
             raise Exception("Could not connect to ChromaDB")
+    return chroma_cli
+
+
+def collection_name(pitch_id):
+    return f"{COLLECTION_PREFIX}{pitch_id}"
+
+
+def restore_collection(pitch_id):
+    """
+    Put back a collection left aside by a rebuild that crashed after moving
+    the old collection away and before the rebuilt one took its name.
+    Only holders of the pitch vector index lock may call it, a rebuild in
+    progress also has the primary name free for a moment.
+    """
+    client = get_chroma_client()
+    name = collection_name(pitch_id)
+    try:
+        client.get_collection(name)
+        return
+    except ValueError:  # primary missing
+        pass
+    try:
+        aside = client.get_collection(f"{name}{ASIDE_SUFFIX}")
+    except ValueError:  # nothing to restore
+        return
+    aside.modify(name=name)
+
+
+def find_vec_collection(pitch_id):
+    """the pitch collection for reading, None if it has none"""
+    try:
+        return get_chroma_client().get_collection(
+            collection_name(pitch_id), embedding_function=get_embedding_func()
+        )
+    except ValueError:
+        return None
+
 
-    collection = chroma_cli.get_or_create_collection(
-        f"pitch_collection_{pitch_id}", embedding_function=get_embedding_func()
+def get_vec_collection(pitch_id):
+    collection = get_chroma_client().get_or_create_collection(
+        collection_name(pitch_id), embedding_function=get_embedding_func()
     )
     return collection
 
@@ -31,43 +80,225 @@ def get_embedding_func():
     return default_ef
 
 
-def load_and_embed(pitch_id, file_path, keywords: List[str]):
-    collection = get_vec_collection(pitch_id)
+def get_encoding():
+    global encoding
+    if encoding is None:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return encoding
+
+
+def chunk_text(
+    text, suffix="", chunk_tokens=RAG_CHUNK_TOKENS, overlap=RAG_CHUNK_OVERLAP
+):
+    """
+    Split text into windows of at most `chunk_tokens` tokens (suffix included),
+    consecutive windows sharing `overlap` tokens.
+
+    Returns:
+        [(chunk text, token count)]
+    """
+    enc = get_encoding()
+    tokens = enc.encode(text)
+    suffix_tokens = len(enc.encode(suffix)) if suffix else 0
+    size = max(1, chunk_tokens - suffix_tokens)
+    step = max(1, size - overlap)
+    chunks = []
+    for start in range(0, len(tokens), step):
+        chunk = enc.decode(tokens[start : start + size]) + suffix
+        chunks.append((chunk, len(enc.encode(chunk))))
+        if start + size >= len(tokens):
+            break
+    return chunks
+
+
+def load_chunks(pitch_id, doc_id, file_path, keywords: List[str]):
+    """
+    Split the pdf page by page into token sized chunks ready to embed.
+    Every chunk keeps its document, page, index and token count in metadata,
+    its id is <doc_id>:<page>:<chunk> so re-embedding a document overwrites it.
+
+    Returns:
+        (documents, metadatas, ids, pages)
+    """
     loader = PyPDFLoader(file_path)
-    pages = loader.load_and_split()
+    pages = loader.load()
+    keyword_suffix = "\n" + " ".join(
+        ["KEYWORD:{}".format(keyword) for keyword in keywords]
+    )
 
     documents = []
     metadatas = []
     ids = []
     for page in pages:
-        documents.append(
-            page.page_content
-            + "\n"
-            + " ".join(["KEYWORD:{}".format(keyword) for keyword in keywords])
-        )
-        metadatas.append({"pitch_id": pitch_id, "doc_type": "pdf"})
-        ids.append(str(uuid.uuid4()))
+        page_number = page.metadata.get("page", 0) + 1
+        if not page.page_content.strip():
+            continue
+        for index, (chunk, tokens) in enumerate(
+            chunk_text(page.page_content, keyword_suffix)
+        ):
+            documents.append(chunk)
+            metadatas.append(
+                {
+                    "pitch_id": pitch_id,
+                    "doc_type": "pdf",
+                    "doc_id": doc_id,
+                    "page": page_number,
+                    "chunk": index,
+                    "tokens": tokens,
+                }
+            )
+            ids.append(f"{doc_id}:{page_number}:{index}")
+    return documents, metadatas, ids, pages
 
-    try:
-        collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids,
-        )
-    except Exception as e:
-        print(e)
-        raise e
 
+def embed_chunks(
+    pitch_id, documents, metadatas, ids, batch_size=EMBED_BATCH_SIZE, on_batch=None
+):
+    """
+    Embed and upsert chunks into the pitch collection `batch_size` at a time.
+    on_batch(done, total) is called after every batch.
+    """
+    collection = get_vec_collection(pitch_id)
+    total = len(documents)
+    for start in range(0, total, batch_size):
+        end = min(start + batch_size, total)
+        try:
+            collection.upsert(
+                documents=documents[start:end],
+                metadatas=metadatas[start:end],
+                ids=ids[start:end],
+            )
+        except Exception as e:
+            print(e)
+            raise e
+        if on_batch:
+            on_batch(end, total)
+
+
+def load_and_embed(pitch_id, doc_id, file_path, keywords: List[str], on_batch=None):
+    documents, metadatas, ids, pages = load_chunks(
+        pitch_id, doc_id, file_path, keywords
+    )
+    embed_chunks(pitch_id, documents, metadatas, ids, on_batch=on_batch)
     return pages
 
 
-def retrieve_context(query, k=10, filters={}):
+def remove_document(pitch_id, doc_id):
+    """delete every chunk of a document from the pitch collection"""
+    get_vec_collection(pitch_id).delete(where={"doc_id": doc_id})
+
+
+def scan_collection(collection, include=("metadatas",)):
+    """yield get() batches of the whole collection"""
+    offset = 0
+    while True:
+        batch = collection.get(
+            include=list(include), limit=SCAN_BATCH_SIZE, offset=offset
+        )
+        if not batch["ids"]:
+            return
+        yield batch
+        offset += len(batch["ids"])
+
+
+def index_bytes():
+    """bytes on disk of the vector db, sqlite plus every hnsw segment"""
+    total = 0
+    for root, _, files in os.walk(VEC_DB_PATH):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+
+def pitch_collection_ids():
+    """pitch ids that have a collection, or one set aside by a crashed rebuild"""
+    pitch_ids = set()
+    for collection in get_chroma_client().list_collections():
+        suffix = collection.name[len(COLLECTION_PREFIX) :]
+        if suffix.endswith(ASIDE_SUFFIX):
+            suffix = suffix[: -len(ASIDE_SUFFIX)]
+        if collection.name.startswith(COLLECTION_PREFIX) and suffix.isdigit():
+            pitch_ids.add(int(suffix))
+    return sorted(pitch_ids)
+
+
+def rebuild_collection(pitch_id):
+    """
+    Copy the live vectors of a pitch into a fresh collection and swap it in.
+    hnsw never gives back the space of deleted vectors, a rebuild does.
+    Embeddings are copied, nothing is embedded again.
+    The old collection is only moved aside until the new one has its name,
+    so a crash at any point leaves a complete copy for restore_collection.
+    """
+    client = get_chroma_client()
+    name = collection_name(pitch_id)
+    old = get_vec_collection(pitch_id)
+    rebuild_name = f"{name}{REBUILD_SUFFIX}"
+    aside_name = f"{name}{ASIDE_SUFFIX}"
+    for leftover in (rebuild_name, aside_name):
+        try:
+            client.delete_collection(leftover)
+        except ValueError:  # no leftover from an interrupted rebuild
+            pass
+    new = client.create_collection(
+        rebuild_name, metadata=old.metadata, embedding_function=get_embedding_func()
+    )
+    for batch in scan_collection(old, ("embeddings", "documents", "metadatas")):
+        new.add(
+            ids=batch["ids"],
+            embeddings=batch["embeddings"],
+            documents=batch["documents"],
+            metadatas=batch["metadatas"],
+        )
+    old.modify(name=aside_name)
+    new.modify(name=name)
+    client.delete_collection(aside_name)
+
+
+def gc_collection(pitch_id, live_doc_ids, rebuild=True):
+    """
+    Delete the vectors of a pitch whose doc_id is not in `live_doc_ids`, then
+    rebuild the collection if anything was deleted. Vectors embedded before
+    chunks carried a doc_id cannot be attributed and are kept.
+    A collection left empty is dropped.
+
+    Returns:
+        {"pitch_id", "vectors_before", "vectors_after", "orphans"}
+    """
+    collection = get_vec_collection(pitch_id)
+    before = collection.count()
+    orphans = []
+    for batch in scan_collection(collection):
+        for vector_id, metadata in zip(batch["ids"], batch["metadatas"]):
+            doc_id = (metadata or {}).get("doc_id")
+            if doc_id is not None and doc_id not in live_doc_ids:
+                orphans.append(vector_id)
+    for start in range(0, len(orphans), SCAN_BATCH_SIZE):
+        collection.delete(ids=orphans[start : start + SCAN_BATCH_SIZE])
+
+    after = before - len(orphans)
+    if orphans and after == 0:
+        get_chroma_client().delete_collection(collection_name(pitch_id))
+    elif orphans and rebuild:
+        rebuild_collection(pitch_id)
+    return {
+        "pitch_id": pitch_id,
+        "vectors_before": before,
+        "vectors_after": after,
+        "orphans": len(orphans),
+    }
+
+
+def retrieve_context(query, k=10, filters={}, max_tokens=None):
     """Gets the context from our libraries vector db for a given query.
 
     Args:
         filters: filters, must include pitch to return results
         query (str): User input query
         k (int, optional): number of retrieved results. Defaults to 10.
+        max_tokens (int, optional): token budget of the context, results are
+            kept in rank order while they fit. Uses the chunk token counts
+            stored at embedding time, nothing is re-encoded.
     """
 
     # First, we query the API
@@ -75,15 +306,34 @@ def retrieve_context(query, k=10, filters={}):
     if not pitch_id:
         return None
 
-    collection = get_vec_collection(pitch_id)
-    responses = collection.query(query_texts=[query], n_results=k, where=filters)
+    # never create: a rebuild may have the collection under another name
+    collection = find_vec_collection(pitch_id)
+    if collection is None:
+        return {"role": "user", "content": ""}
+    responses = collection.query(
+        query_texts=[query],
+        n_results=k,
+        where=filters,
+        include=["documents", "metadatas"],
+    )
 
     # Then, we build the prompt_with_context string
     prompt_with_context = ""
+    used_tokens = 0
+    header_tokens = len(get_encoding().encode(CONTEXT_HEADER))
     # chroma thing, it's wierd, map query to documents, documents is a list of list, each list contain ACTUAL result tied to the query in query_texts list in order
     if len(responses["documents"]) > 0:
-        for response in responses["documents"][0]:
-            prompt_with_context += f"\n\n### Context ###\n{response}"
+        for response, metadata in zip(
+            responses["documents"][0], responses["metadatas"][0]
+        ):
+            if max_tokens is not None:
+                tokens = (metadata or {}).get("tokens")
+                if tokens is None:  # embedded before chunks had token counts
+                    tokens = len(get_encoding().encode(response))
+                if used_tokens + header_tokens + tokens > max_tokens:
+                    break
+                used_tokens += header_tokens + tokens
+            prompt_with_context += f"{CONTEXT_HEADER}{response}"
     return {"role": "user", "content": prompt_with_context}
 
 
@@ -105,7 +355,7 @@ def construct_prompt(
     Returns:
     List[dict]: The constructed RAG prompt.
     """
-    encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding()
 
     # 1) calculate tokens
     reserved_space = 1000
@@ -193,6 +443,7 @@ def construct_prompt(
 
 if __name__ == "__main__":
     pages = load_and_embed(
+        1,
         1,
         "/Volumes/station/src/pitch_anything/service/uploads/airbnb.pdf",
         ["airbnb", "rental"],
@@ -0,0 +1,163 @@
+import logging
+import os
+import re
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+from config import (
+    RASTER_DPI,
+    RASTER_FORMAT,
+    RASTER_PAGES_PER_BATCH,
+    RASTER_WORKERS,
+    MODEL_IMAGE_SIZE,
+    VIDEO_FRAME_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+FORMAT_EXTENSIONS = {"jpeg": "jpg", "png": "png"}
+SLIDE_PATTERN = re.compile(r"^slide_(\d+)\.(jpg|png)$")
+
+# rendition name -> (sub folder of the pitch folder, max pixel size)
+VIDEO_RENDITION = "video"
+MODEL_RENDITION = "model"
+RENDITIONS = {
+    VIDEO_RENDITION: ("", VIDEO_FRAME_SIZE),
+    MODEL_RENDITION: (MODEL_RENDITION, MODEL_IMAGE_SIZE),
+}
+
+
+def parse_size(size):
+    """'1920x1080' -> (1920, 1080), empty -> None"""
+    if not size:
+        return None
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def peak_rss_mb():
+    """peak resident memory of this process and of its (pdftoppm) children"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KB on linux
+    return round(own / 1024, 1), round(children / 1024, 1)
+
+
+def page_count(pdf_path):
+    return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+
+def slide_paths(folder):
+    """slide images in `folder` ordered by slide index, not listdir order"""
+    if not os.path.isdir(folder):
+        return []
+    slides = []
+    for file in os.listdir(folder):
+        match = SLIDE_PATTERN.match(file)
+        if match:
+            slides.append((int(match.group(1)), os.path.join(folder, file)))
+    return [path for _, path in sorted(slides)]
+
+
+def _render_batch(pdf_path, output_folder, first, last, renditions, dpi, fmt):
+    """render pages first..last and write every rendition of each page"""
+    ext = FORMAT_EXTENSIONS[fmt]
+    results = []
+    images = convert_from_path(pdf_path, dpi, first_page=first, last_page=last)
+    for offset, image in enumerate(images):
+        page = first + offset
+        paths = {}
+        for name, (sub_folder, size) in renditions.items():
+            max_size = parse_size(size)
+            rendition = image.copy() if max_size else image
+            if max_size:
+                rendition.thumbnail(max_size)
+            image_path = os.path.join(output_folder, sub_folder, f"slide_{page}.{ext}")
+            rendition.save(image_path, fmt.upper())
+            if rendition is not image:
+                rendition.close()
+            paths[name] = image_path
+        image.close()
+        results.append((page, paths))
+    return results
+
+
+def rasterize(
+    pdf_path,
+    output_folder,
+    renditions=RENDITIONS,
+    dpi=RASTER_DPI,
+    fmt=RASTER_FORMAT,
+    pages_per_batch=RASTER_PAGES_PER_BATCH,
+    workers=RASTER_WORKERS,
+):
+    """
+    Render the pdf in batches of `pages_per_batch` pages and yield
+    (page, {rendition: image path}) in page order as slides are written.
+
+    Up to `workers` batches render at once. Each batch is its own pdftoppm
+    process, so the threads here only wait on it and resize, and at most
+    workers * pages_per_batch bitmaps are held in memory.
+    Pages are 1 based and saved as <sub folder>/slide_<page>.<ext>.
+    """
+    for sub_folder, _ in renditions.values():
+        os.makedirs(os.path.join(output_folder, sub_folder), exist_ok=True)
+    total = page_count(pdf_path)
+    batches = [
+        (first, min(first + pages_per_batch - 1, total))
+        for first in range(1, total + 1, pages_per_batch)
+    ]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        jobs = executor.map(
+            lambda batch: _render_batch(
+                pdf_path, output_folder, batch[0], batch[1], renditions, dpi, fmt
+            ),
+            batches,
+        )
+        for results in jobs:
+            yield from results
+
+    own, children = peak_rss_mb()
+    logger.info(
+        f"rasterized {total} pages of {pdf_path} at {dpi} dpi with {workers} workers, "
+        f"peak rss {own} MB (pdftoppm {children} MB)"
+    )
+
+
+def _folder_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+if __name__ == "__main__":
+    # benchmark: python raster.py <deck.pdf> [output folder]
+    # compares the old in-memory 300 dpi path with the parallel rendition path
+    pdf = sys.argv[1]
+    out = sys.argv[2] if len(sys.argv) > 2 else "raster_bench"
+
+    legacy_folder = os.path.join(out, "legacy")
+    os.makedirs(legacy_folder, exist_ok=True)
+    start = time.perf_counter()
+    legacy_paths = []
+    for i, image in enumerate(convert_from_path(pdf, 300)):
+        legacy_paths.append(os.path.join(legacy_folder, f"slide_{i + 1}.jpg"))
+        image.save(legacy_paths[-1], "JPEG")
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pages = list(rasterize(pdf, os.path.join(out, "renditions")))
+    seconds = time.perf_counter() - start
+
+    model_paths = [paths[MODEL_RENDITION] for _, paths in pages]
+    print(f"pages: {len(pages)}, workers: {RASTER_WORKERS}")
+    print(
+        f"legacy:     {legacy_seconds:.2f}s, "
+        f"uploaded {_folder_bytes(legacy_paths) / 1024 / 1024:.1f} MB"
+    )
+    print(
+        f"renditions: {seconds:.2f}s, "
+        f"uploaded {_folder_bytes(model_paths) / 1024 / 1024:.1f} MB"
+    )
@@ -0,0 +1,181 @@
+import functools
+import logging
+import random
+import time
+
+import openai
+import tiktoken
+from google.api_core import exceptions as google_exceptions
+
+import cache
+from config import RATE_LIMITS, RATE_LIMIT_MAX_RETRIES, RATE_LIMIT_MAX_DELAY
+
+logger = logging.getLogger(__name__)
+
+# Token bucket refilled continuously at `rate` tokens per second up to `capacity`.
+# Returns 0 when the tokens were taken, otherwise the seconds to wait before
+# enough tokens are available (nothing is taken in that case).
+# Uses the redis clock so every worker shares the same notion of time.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local requested = math.min(tonumber(ARGV[3]), capacity)
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+  tokens = tokens - requested
+else
+  wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+token_bucket = None
+encoding = None
+
+# statuses worth another attempt: timeouts, throttling and server errors (5xx)
+TRANSIENT_STATUS = {408, 429}
+
+
+class EmptyResponse(Exception):
+    pass
+
+
+# failures without a status that retrying can fix
+TRANSIENT_ERRORS = (
+    EmptyResponse,
+    TimeoutError,
+    ConnectionError,
+    openai.APIConnectionError,  # APITimeoutError included
+    google_exceptions.RetryError,
+)
+
+
+def _take(key, per_minute, requested):
+    global token_bucket
+    if token_bucket is None:
+        token_bucket = cache.get_redis_client().register_script(TOKEN_BUCKET_SCRIPT)
+    return float(
+        token_bucket(keys=[key], args=[per_minute, per_minute / 60, requested])
+    )
+
+
+def acquire(provider, tokens=0):
+    """
+    Block until the provider's request (and token, when `tokens` is given)
+    budget allows one more call. Budgets are shared through redis by every
+    worker. If redis is unreachable calls are let through.
+    """
+    limits = RATE_LIMITS.get(provider, {})
+    buckets = [("rpm", 1), ("tpm", tokens)]
+    for name, requested in buckets:
+        per_minute = limits.get(name, 0)
+        if not per_minute or not requested:
+            continue
+        key = f"ratelimit:{provider}:{name}"
+        while True:
+            try:
+                wait = _take(key, per_minute, requested)
+            except Exception as e:
+                print(f"Error acquiring rate limit: {e}")
+                break
+            if wait <= 0:
+                break
+            time.sleep(wait)
+
+
+def estimate_tokens(text, completion=1000):
+    """rough token cost of a chat call: prompt tokens plus a completion allowance"""
+    global encoding
+    if encoding is None:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return len(encoding.encode(text)) + completion
+
+
+def _status_code(error):
+    for attr in ("status_code", "code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_transient(error):
+    """
+    Whether a failed call may succeed when retried. Errors can decide with a
+    `transient` attribute, anything else unknown (bugs, bad input) is not.
+    """
+    transient = getattr(error, "transient", None)
+    if transient is not None:
+        return bool(transient)
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    status = _status_code(error)
+    return status is not None and (status in TRANSIENT_STATUS or status >= 500)
+
+
+def retry_after(error):
+    """seconds the provider asked us to wait, if it said so"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def backoff_delay(attempt, error, base_delay=1.0, max_delay=RATE_LIMIT_MAX_DELAY):
+    """Retry-After when given, otherwise exponential backoff with full jitter"""
+    delay = retry_after(error)
+    if delay is not None:
+        return min(delay, max_delay)
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+def rate_limited(provider, tokens=None, max_retries=RATE_LIMIT_MAX_RETRIES):
+    """
+    Decorator for outbound model calls. Every attempt first takes from the
+    provider's shared budget, transient failures are retried with backoff and
+    any other error is raised at once.
+
+    Args:
+        provider: key of config.RATE_LIMITS
+        tokens: callable returning the token cost from the call's arguments
+        max_retries: retries after the first attempt, the last error is raised
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cost = tokens(*args, **kwargs) if tokens else 0
+            attempt = 0
+            while True:
+                acquire(provider, cost)
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if attempt >= max_retries or not is_transient(e):
+                        raise
+                    delay = backoff_delay(attempt, e)
+                    logger.warning(
+                        f"{provider} call failed ({_status_code(e)}): {e}, "
+                        f"retry {attempt + 1}/{max_retries} in {delay:.1f}s"
+                    )
+                    attempt += 1
+                    time.sleep(delay)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import cache
+from common import file_sha256, prune_lru, touch
+from config import (
+    RESPONSE_CACHE_BACKEND,
+    RESPONSE_CACHE_DIR,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_MAX_ENTRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# prune the disk cache every n writes instead of walking it on every write
+PRUNE_EVERY = 50
+
+
+class DiskBackend:
+    def __init__(self, folder, ttl, max_bytes):
+        self.folder = os.path.abspath(folder)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.writes = 0
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if self.ttl and time.time() - entry["created_at"] > self.ttl:
+            os.remove(path)
+            return None
+        touch(path)
+        return entry["value"]
+
+    def set(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"created_at": time.time(), "value": value}, f)
+        os.replace(tmp, path)
+        self.writes += 1
+        if self.writes % PRUNE_EVERY == 0:
+            prune_lru(self.folder, self.max_bytes)
+
+
+class RedisBackend:
+    PREFIX = "response_cache:"
+    LRU_KEY = "response_cache:lru"
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def get(self, key):
+        redis_client = cache.get_redis_client()
+        value = redis_client.get(self.PREFIX + key)
+        if value is not None:
+            redis_client.zadd(self.LRU_KEY, {key: time.time()})
+        return value
+
+    def set(self, key, value):
+        redis_client = cache.get_redis_client()
+        pipe = redis_client.pipeline()
+        pipe.set(self.PREFIX + key, value, ex=self.ttl or None)
+        pipe.zadd(self.LRU_KEY, {key: time.time()})
+        pipe.zcard(self.LRU_KEY)
+        overflow = pipe.execute()[-1] - self.max_entries
+        if overflow > 0:
+            evicted = redis_client.zpopmin(self.LRU_KEY, overflow)
+            redis_client.delete(*[self.PREFIX + member for member, _ in evicted])
+
+
+class ResponseCache:
+    """
+    Caches model responses keyed on model name, rendered prompt, image content
+    hashes and sampling params. Only text responses are stored.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, prompt, images=(), params=None):
+        payload = json.dumps(
+            {
+                "model": model,
+                "prompt": prompt,
+                "images": [file_sha256(image) for image in images],
+                "params": params or {},
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_or_call(self, call, model, prompt, images=(), params=None, validate=None):
+        """
+        Return the cached response for these inputs, otherwise run call() and
+        cache its (non empty) text result.
+
+        validate(value) raising means the response is unusable: a cached one is
+        dropped and fetched again, a fresh one is raised and never cached.
+        """
+        if self.backend is None:
+            value = call()
+            if validate:
+                validate(value)
+            return value
+
+        key = self.make_key(model, prompt, images, params)
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            print(f"Error getting cached response: {e}")
+            value = None
+        if value is not None and validate:
+            try:
+                validate(value)
+            except Exception as e:
+                logger.info(f"response cache entry {key} is invalid, refetching: {e}")
+                value = None
+        with self.lock:
+            if value is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if value is not None:
+            logger.info(f"response cache hit {model} {key}")
+            return value
+
+        value = call()
+        if validate:
+            validate(value)
+        if value:
+            try:
+                self.backend.set(key, value)
+            except Exception as e:
+                print(f"Error caching response: {e}")
+        return value
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+response_cache_instance = None
+response_cache_lock = threading.Lock()
+
+
+def response_cache() -> ResponseCache:
+    global response_cache_instance
+    with response_cache_lock:
+        if response_cache_instance is None:
+            if RESPONSE_CACHE_BACKEND == "redis":
+                backend = RedisBackend(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES)
+            elif RESPONSE_CACHE_BACKEND == "disk":
+                backend = DiskBackend(
+                    RESPONSE_CACHE_DIR, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES
+                )
+            else:
+                backend = None
+            response_cache_instance = ResponseCache(backend)
+        return response_cache_instance
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
@@ -15,3 +17,10 @@ class PageTranscript(BaseModel):
     links: list
     medias: list
     references: list
+
+
+class PageEdit(BaseModel):
+    draft: Optional[str] = None
+    speech: Optional[str] = None
+    # also regenerate the pages before and after when their inputs changed
+    neighbours: bool = False
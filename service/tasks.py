@@ -1,19 +1,28 @@
 import json
 import os
 import logging
-import cv2
-from moviepy.editor import VideoFileClip, concatenate_videoclips, AudioFileClip
-from pdf2image import convert_from_path
-from celery import Celery, states
-from celery.signals import after_setup_logger
-import ffmpeg_streaming
-from ffmpeg_streaming import Formats
+import time
+from celery import Celery, chord, group, states
+from celery.signals import after_setup_logger, celeryd_init
 
 
+import cache
 import orm
+import rag
+from artifacts import detach_tree, media_folder_path
+from config import VECTOR_INDEX_LOCK_RETRY, VECTOR_INDEX_LOCK_TIMEOUT
+from raster import rasterize, peak_rss_mb, slide_paths, MODEL_RENDITION
+from response_cache import response_cache
 from schema import PageDraft
-from tts import speech_synthesize
-from transcribe import draft_transcribe, gen_transcript
+from tts import synthesize_page, page_audio_path, prune_audio_store
+from video import (
+    encode_threads,
+    package_hls,
+    prune_segment_store,
+    rendition_jobs,
+    slide_segment,
+)
+from transcribe import draft_transcribe, gen_transcript, speech_input_hashes
 
 # Celery app
 # Configure Celery
@@ -39,6 +48,96 @@ def setup_loggers(logger, *args, **kwargs):
     logger.addHandler(fh)
 
 
+@celeryd_init.connect
+def record_concurrency(conf=None, options=None, **kwargs):
+    """keep the -c of the worker command line in the conf the tasks read"""
+    if conf is not None and options and options.get("concurrency"):
+        conf.worker_concurrency = options["concurrency"]
+
+
+def load_page_drafts(pitch):
+    """checkpointed drafts of a pitch by page"""
+    if not pitch.drafts:
+        return {}
+    return {draft["page"]: PageDraft(**draft) for draft in json.loads(pitch.drafts)}
+
+
+def checkpoint_drafts(pitch, drafts):
+    pitch.drafts = json.dumps([drafts[page].dict() for page in sorted(drafts)])
+    pitch.save()
+
+
+def model_slide_paths(pitch_id):
+    image_dir = os.path.join("uploads", str(pitch_id))
+    image_paths = slide_paths(os.path.join(image_dir, MODEL_RENDITION))
+    if not image_paths:  # decks segmented before model renditions existed
+        image_paths = slide_paths(image_dir)
+    return image_paths
+
+
+def set_stage(task, stage):
+    task.process_stage = stage.value
+    task.save()
+
+
+def run_transcribe(pitch, task, document, stage):
+    """
+    Run the transcribe pipeline starting at `stage`. Drafts and speeches are
+    checkpointed on the pitch as each page completes, so a rerun only redoes
+    the pages that are missing.
+    """
+    if stage.value <= orm.TranscribeStage.SEGMENT.value:
+        # Extract each slide as an image
+        set_stage(task, orm.TranscribeStage.SEGMENT)
+        image_folder = os.path.join("uploads", str(pitch.id))
+        # pages render in parallel batches, only the model sized rendition is
+        # sent to the vision model, the video frame stays in the pitch folder
+        for _ in rasterize(document.storage_path, image_folder):
+            pass
+        logger.info(f"segment peak rss (self, pdftoppm) MB: {peak_rss_mb()}")
+    image_paths = model_slide_paths(pitch.id)
+
+    if stage.value <= orm.TranscribeStage.DRAFT.value:
+        set_stage(task, orm.TranscribeStage.DRAFT)
+        drafts = load_page_drafts(pitch)
+        document.progress = f"{max(len(drafts) - 1, 0)}:{len(image_paths)}"
+        document.save()
+
+        def on_draft(page_draft):
+            drafts[page_draft.page] = page_draft
+            checkpoint_drafts(pitch, drafts)
+
+        page_drafts = draft_transcribe(
+            image_paths, document, done=drafts, on_draft=on_draft
+        )
+        missing = set(range(1, len(image_paths) + 1)) - {d.page for d in page_drafts}
+        if missing:
+            raise Exception(f"failed to draft pages {sorted(missing)}")
+        # speeches written from older drafts are stale
+        pitch.transcript = None
+        pitch.save()
+
+    # write transcripts
+    set_stage(task, orm.TranscribeStage.GEN_TRANSCRIPT)
+    drafts = load_page_drafts(pitch)
+    page_drafts = [drafts[page] for page in sorted(drafts)]
+    speeches = json.loads(pitch.transcript) if pitch.transcript else []
+
+    def on_speech(speeches):
+        pitch.transcript = json.dumps(speeches)
+        pitch.save()
+
+    # save speech for audio dialog generation
+    pitch.transcript = gen_transcript(page_drafts, speeches, on_speech=on_speech)
+    pitch.speech_inputs = json.dumps(
+        speech_input_hashes(page_drafts, json.loads(pitch.transcript))
+    )
+    pitch.save()
+
+    set_stage(task, orm.TranscribeStage.FINISH)
+    logger.info(f"response cache: {response_cache().stats()}")
+
+
 # --------------celery tasks----------------
 @celery.task(bind=True)
 def transcribe(self, param):
@@ -47,52 +146,15 @@ def transcribe(self, param):
     print(f"task id: {task_id}")
     pitch = orm.Pitch(id=param.get("pitch_id")).get()
     task = orm.Task.get_by_task_id(task_id=task_id)
-    print("------------", task.id)
     if not task:
         return {"message": "transcribe task not found", "task_id": task_id}
-    # Extract each slide as an image
-    task.process_stage = orm.TranscribeStage.SEGMENT.value
-    task.save()
-    print("-----------21321312-", task.id)
-    images = convert_from_path(param.get("storage_path"), 300)
-    image_folder = os.path.join("uploads", f"{param.get('pitch_id')}")
-    image_paths = []
-    # update document:
     document = orm.Document.get_by_doc_id(param.get("doc_id"))
     try:
-        for i in range(len(images)):
-            image_path = os.path.join(image_folder, f"slide_{i + 1}.jpg")
-            # Save pages as images in the pdf
-            os.makedirs(os.path.dirname(image_path), exist_ok=True)
-            images[i].save(image_path, "JPEG")
-            image_paths.append(image_path)
-        document.progress = f"0:{len(images)}"
-        document.save()
+        run_transcribe(pitch, task, document, orm.TranscribeStage.SEGMENT)
     except Exception as e:
         print(e)
-        self.update_state(state=states.FAILURE, meta=f"failed to segment pdf: {e}")
-
-    # kick off transcribe
-    task.process_stage = orm.TranscribeStage.DRAFT.value
-    task.save()
-    # save draft
-    page_drafts = draft_transcribe(image_paths, document)
-    page_drafts_json = [draft.dict() for draft in page_drafts]
-    pitch.drafts = json.dumps(page_drafts_json)
-    pitch.save()
-
-    # write transcripts
-    task.process_stage = orm.TranscribeStage.GEN_TRANSCRIPT.value
-    task.save()
-    speech_content = gen_transcript(page_drafts)
-
-    # save speech for audio dialog generation
-    pitch.transcript = speech_content
-    pitch.save()
-
-    task.process_stage = orm.TranscribeStage.FINISH.value
-    task.save()
-    return
+        self.update_state(state=states.FAILURE, meta=f"failed to transcribe: {e}")
+        return {"message": f"transcribe failed: {e}", "task_id": task_id}
 
 
 @celery.task(bind=True)
@@ -100,51 +162,37 @@ def resume(self, param):
     # lookup task associated with pitch
     pitch = orm.Pitch.get_by_pitch_uid(pitch_uid=param.get("pitch_uid"))
     task = orm.Task.get_master_by_pitch_id(pitch_id=pitch.id)
-    master_doc = orm.Document.get_master_by_pitch_id(pitch_id=param.get("pitch_id"))
+    master_doc = orm.Document.get_master_by_pitch_id(pitch_id=pitch.id)
     print(f"task stage {task.process_stage}")
     stage = orm.TranscribeStage(task.process_stage)
-    if stage == orm.TranscribeStage.SEGMENT:  # send to drafting
-        # kick off transcribe
-        task.process_stage = orm.TranscribeStage.DRAFT.value
-        task.save()
-        stage = orm.TranscribeStage(task.process_stage)
-        # lookup image paths
-        image_dir = os.path.join("uploads", f"{param.get('pitch_id')}")
-        image_paths = []
-        for file in os.listdir(image_dir):
-            if file.endswith(".jpg"):
-                image_paths.append(os.path.join(image_dir, file))
-        page_drafts = draft_transcribe(image_paths, master_doc)
-        page_drafts_json = [draft.dict() for draft in page_drafts]
-        pitch.drafts = json.dumps(page_drafts_json)
-        pitch.save()
-
-    # continue
-    if stage == orm.TranscribeStage.DRAFT:  # send to trascribe
-        # write transcripts
-        page_drafts_dict = json.loads(pitch.drafts)
-        page_drafts = [PageDraft(**draft) for draft in page_drafts_dict]
-        task.process_stage = orm.TranscribeStage.GEN_TRANSCRIPT.value
-        task.save()
-        stage = orm.TranscribeStage(task.process_stage)
-        speech_content = gen_transcript(page_drafts)
-        # save speech for audio dialog generation
-        pitch = orm.Pitch(id=param.get("pitch_id")).get()
-        pitch.transcript = speech_content
-
-        pitch.save()
-
-        task.process_stage = orm.TranscribeStage.FINISH.value
-        task.save()
-
     if stage == orm.TranscribeStage.FINISH:  # send to finish
-        # create audio file
         return {"message": "transcribe completed"}
 
+    # pick up from the recorded stage, checkpointed pages are not redone
+    try:
+        run_transcribe(pitch, task, master_doc, stage)
+    except Exception as e:
+        print(e)
+        self.update_state(state=states.FAILURE, meta=f"failed to resume: {e}")
+        return {"message": f"transcribe failed: {e}", "task_id": task.task_id}
+    return {"message": "transcribe completed"}
+
 
 @celery.task(bind=True)
 def ssml_audio_sync(self, param):
-    # convert to ssml
+    """
+    Start the audio and video pipeline of a pitch as a canvas:
+
+        chord(synthesize_page_audio per page)
+          -> audio_done: stage AUDIO,
+             chord(encode_slide_segment per slide and rendition)
+               -> assemble_playlist: stage FINISH
+
+    Every page and every slide segment is its own task, so a deck spreads
+    over all workers and a failed page is retried on its own. Finished audio
+    and segments are kept in their content addressed stores, a rerun after
+    a failure only redoes what is missing. Any failure sets stage FAILED.
+    """
     speeches = param.get("speeches")
     pitch_id = param.get("pitch_id")
     task_id = param.get("task_id")
@@ -157,102 +205,214 @@ def ssml_audio_sync(self, param):
         return {"message": "ssml audio sync task not found", "task_id": task_id}
 
     try:
-        for i, speech in enumerate(speeches):
-            # ssml = text_to_ssml(speech)
-            ssml = speech
-            retries = 0
-            while retries < 3:
-                try:
-                    audio_success = speech_synthesize(ssml, pitch_id, i + 1)
-                    if audio_success:
-                        break
-                except Exception as e:
-                    print(e)
-                    retries += 1
-
-        task.process_stage = orm.AudioStage.AUDIO.value
-        task.save()
-
-        # create video
-        image_dir = os.path.join("uploads", f"{param.get('pitch_id')}")
-        image_paths = []
-        for file in os.listdir(image_dir):
-            if file.endswith(".jpg"):
-                image_paths.append(os.path.join(image_dir, file))
-        image_paths.sort(key=lambda x: int(x.split("_")[1].split(".")[0]))
-
-        # Initialize an empty list to hold individual video clips
-        video_clips = []
-        video_name = os.path.join("media", str(pitch_id), "video.mp4")
-        tmp_paths = []
-        for i, img in enumerate(image_paths):
-            tmp_path = os.path.join("media", str(pitch_id), f"{i + 1}_temp.avi")
-            tmp_paths.append(tmp_path)
-            # Assuming audio files have same name as images but with .wav extension
-            audio_file = os.path.abspath(
-                os.path.join("media", str(pitch_id), str(i + 1) + ".wav")
-            )
-            print(f"audio file: {audio_file}")
-            print(f"image: {img}")
-
-            # Get the duration of the audio file
-            audio_clip = AudioFileClip(audio_file)
-            audio_duration = audio_clip.duration
-
-            # Load the image
-            frame = cv2.imread(img)
-            height, width, layers = frame.shape
-
-            # Create a video clip from the image
-            video_clip = cv2.VideoWriter(tmp_path, 0, 1, (width, height))
-
-            # Display the image for the duration of the corresponding audio file
-            num_frames = int(audio_duration * 1)  # 1 fps
-
-            for _ in range(num_frames):
-                video_clip.write(frame)
-
-            # Release the video writer
-            video_clip.release()
-
-            # Load the video clip with moviepy to attach audio
-            video_clip = VideoFileClip(tmp_path)
-            video_clip = video_clip.set_audio(audio_clip)
-            video_clips.append(video_clip)
-
-        # Concatenate all the video clips
-        final_clip = concatenate_videoclips(video_clips, method="compose")
-
-        # Write the result to a file
-        final_clip.write_videofile(
-            video_name, codec="libx264", fps=1, audio_codec="aac"
+        # media may still be hard linked with a deduplicated pitch, unshare it first
+        detach_tree(media_folder_path(pitch_id))
+        pages = group(
+            synthesize_page_audio.s(speech, pitch_id, i + 1)
+            for i, speech in enumerate(speeches)
         )
+        callback = audio_done.s(param).on_error(audio_failed.s(task_id))
+        chord(pages)(callback)
+    except Exception as e:
+        print(e)
+        set_stage(task, orm.AudioStage.FAILED)
+        return {"message": "ssml audio sync failed", "task_id": task_id}
 
-        # Clean up temporary files
-        for clip in video_clips:
-            clip.close()
+    return {"message": "ssml audio sync started", "task_id": task_id}
 
-        for file_path in tmp_paths:
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                print(f"Error occurred while trying to remove {file_path}: {e}")
 
-        # Release resources
-        cv2.destroyAllWindows()
+@celery.task
+def synthesize_page_audio(speech, pitch_id, sequence):
+    start = time.perf_counter()
+    # retried with backoff inside, see speech_synthesize
+    duration, reused = synthesize_page(speech, pitch_id, sequence)
+    return {
+        "page": sequence,
+        "seconds": round(time.perf_counter() - start, 2),
+        "reused": reused,
+        "duration": duration,
+        "bytes": os.path.getsize(page_audio_path(pitch_id, sequence)),
+    }
 
-        # create m3u8
-        video = ffmpeg_streaming.input(video_name)
-        hls = video.hls(Formats.h264())
-        hls.auto_generate_representations()
-        hls.output(os.path.join("media", str(pitch_id), "index.m3u8"))
 
-        task.process_stage = orm.AudioStage.FINISH.value
-        task.save()
+@celery.task
+def audio_done(pages, param):
+    """every page has audio: fan out the slide encodes"""
+    pitch_id = param.get("pitch_id")
+    task_id = param.get("task_id")
+    task = orm.Task.get_by_task_id(task_id=task_id)
+    set_stage(task, orm.AudioStage.AUDIO)
+
+    logger.info(f"tts pages: {pages}")
+    logger.info(
+        f"tts audio: {sum(page['bytes'] for page in pages) / 1024 / 1024:.1f} MB"
+    )
+    prune_audio_store()
+
+    image_paths = slide_paths(os.path.join("uploads", str(pitch_id)))
+    audio_paths = [page_audio_path(pitch_id, i + 1) for i in range(len(image_paths))]
+    # durations as reported by the speech service, no need to decode
+    durations = [page["duration"] for page in pages[: len(image_paths)]]
+    jobs = rendition_jobs(image_paths, audio_paths, durations)
+
+    audio_reused = sum(1 for page in pages if page["reused"])
+    summary = {
+        "pages": len(image_paths),
+        "audio_reused": audio_reused,
+        "audio_synthesized": len(pages) - audio_reused,
+        "started_at": time.time(),
+    }
+    callback = assemble_playlist.s(param, summary).on_error(audio_failed.s(task_id))
+    chord(encode_slide_segment.s(*job) for job in jobs)(callback)
+    return summary
+
+
+def worker_encode_threads():
+    """
+    x264 threads per segment: the segments of a canvas run as tasks, as many
+    at a time as the worker has processes, not VIDEO_WORKERS
+    """
+    return encode_threads(celery.conf.worker_concurrency or os.cpu_count() or 1)
+
+
+@celery.task
+def encode_slide_segment(image_path, audio_path, duration, video_args, audio_args):
+    start = time.perf_counter()
+    segment, reused = slide_segment(
+        image_path,
+        audio_path,
+        duration,
+        video_args,
+        audio_args,
+        threads=worker_encode_threads(),
+    )
+    return segment, round(time.perf_counter() - start, 2), reused
+
+
+@celery.task
+def assemble_playlist(segments, param, summary):
+    """every slide segment is encoded: package the hls playlists"""
+    pitch_id = param.get("pitch_id")
+    task_id = param.get("task_id")
+    task = orm.Task.get_by_task_id(task_id=task_id)
+    set_stage(task, orm.AudioStage.VIDEO)
+
+    # slides are encoded one segment each per rendition, the hls renditions
+    # are packaged from the segments by stream copy
+    video = package_hls(segments, summary["pages"], media_folder_path(pitch_id))
+    prune_segment_store()
+    video_reused = sum(1 for slide in video["slides"] if slide["reused"])
+    logger.info(
+        f"video: {summary['pages']} slides ({video_reused} reused) "
+        f"in {time.time() - summary['started_at']:.2f}s, "
+        f"renditions {video['renditions']}"
+    )
+
+    set_stage(task, orm.AudioStage.FINISH)
+    return {
+        "message": "ssml audio sync completed",
+        "task_id": task_id,
+        "audio_reused": summary["audio_reused"],
+        "audio_synthesized": summary["audio_synthesized"],
+        "video_reused": video_reused,
+        "video_encoded": len(video["slides"]) - video_reused,
+        "renditions": video["renditions"],
+    }
+
+
+@celery.task
+def audio_failed(request, exc, traceback, task_id):
+    """errback of the audio pipeline chords"""
+    logger.error(f"ssml audio sync {task_id} failed in {request.id}: {exc}")
+    task = orm.Task.get_by_task_id(task_id=task_id)
+    if task:
+        set_stage(task, orm.AudioStage.FAILED)
+
+
+def vector_index_lock(pitch_id):
+    """lock shared by the tasks that write a pitch vector collection"""
+    return f"vector_index:{pitch_id}"
+
+
+@celery.task(bind=True)
+def embed_reference(self, param):
+    """
+    Parse, chunk and embed a reference document in batches, progress goes to
+    the embedding task row (stage) and the document (done:total chunks).
+    """
+    task_id = param.get("task_id")
+    task = orm.Task.get_by_task_id(task_id=task_id)
+    document = orm.Document.get_by_doc_id(doc_id=param.get("doc_id"))
+    if not task or not document:
+        return {"message": "embedding task not found", "task_id": task_id}
+
+    # a gc rebuild of the same collection would drop what is upserted meanwhile
+    lock_id = vector_index_lock(document.pitch_id)
+    if not cache.acquire_lock(lock_id, lock_timeout=VECTOR_INDEX_LOCK_TIMEOUT):
+        raise self.retry(countdown=VECTOR_INDEX_LOCK_RETRY, max_retries=None)
+
+    try:
+        rag.restore_collection(document.pitch_id)
+        set_stage(task, orm.EmbeddingStage.PROCESSING)
+        keywords = document.keywords.split(",") if document.keywords else []
+        documents, metadatas, ids, _ = rag.load_chunks(
+            document.pitch_id, document.id, document.storage_path, keywords
+        )
+        set_stage(task, orm.EmbeddingStage.EMBEDDING)
+
+        def on_batch(done, total):
+            document.progress = f"{done}:{total}"
+            document.save()
+
+        on_batch(0, len(documents))
+        rag.embed_chunks(
+            document.pitch_id, documents, metadatas, ids, on_batch=on_batch
+        )
+
+        document.processed = 1
+        document.save()
+        set_stage(task, orm.EmbeddingStage.FINISH)
     except Exception as e:
         print(e)
-        task.process_stage = orm.AudioStage.FAILED.value
-        task.save()
-        return {"message": "ssml audio sync failed", "task_id": task_id}
-
-    return {"message": "ssml audio sync completed", "task_id": task_id}
+        set_stage(task, orm.EmbeddingStage.FAILED)
+        return {"message": f"embedding failed: {e}", "task_id": task_id}
+    finally:
+        cache.release_lock(lock_id)
+
+    return {"message": "embedding completed", "task_id": task_id, "chunks": len(ids)}
+
+
+@celery.task
+def gc_vector_index(rebuild=True):
+    """
+    Drop vectors of reference documents that no longer exist from every pitch
+    collection and rebuild the collections that had any. Reports the index
+    size before and after.
+    """
+    bytes_before = rag.index_bytes()
+    collections = []
+    for pitch_id in rag.pitch_collection_ids():
+        lock_id = vector_index_lock(pitch_id)
+        if not cache.acquire_lock(lock_id, lock_timeout=VECTOR_INDEX_LOCK_TIMEOUT):
+            logger.info(f"vector index gc: pitch {pitch_id} busy, skipped")
+            continue
+        try:
+            rag.restore_collection(pitch_id)
+            # read under the lock so a document embedded just before counts
+            docs = orm.Document.get_ref_docs_by_pitch_id(pitch_id=pitch_id)
+            if docs is None:  # lookup failed, do not treat every vector as orphan
+                continue
+            live_doc_ids = {doc.id for doc in docs}
+            collections.append(rag.gc_collection(pitch_id, live_doc_ids, rebuild))
+        except Exception as e:  # one broken collection must not stop the others
+            logger.error(f"vector index gc: pitch {pitch_id} failed: {e}")
+        finally:
+            cache.release_lock(lock_id)
+    report = {
+        "bytes_before": bytes_before,
+        "bytes_after": rag.index_bytes(),
+        "orphans": sum(collection["orphans"] for collection in collections),
+        "collections": collections,
+    }
+    logger.info(f"vector index gc: {report}")
+    return report
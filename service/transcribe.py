@@ -1,6 +1,10 @@
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import vertexai
 from vertexai.preview.generative_models import (
@@ -8,32 +12,89 @@ from vertexai.preview.generative_models import (
     Image as VertextImg,
 )
 from schema import PageDraft
-from config import PROJECT_ID, LOC
+from config import (
+    PROJECT_ID,
+    LOC,
+    DRAFT_CONCURRENCY,
+    TRANSCRIPT_MODE,
+    TRANSCRIPT_CONCURRENCY,
+    SMOOTH_BATCH_SIZE,
+    TRANSCRIPT_BATCH_TOKENS,
+    TRANSCRIPT_BATCH_MAX_PAGES,
+    TRANSCRIPT_SPEECH_TOKENS,
+)
 from llm import llm_client
+from response_cache import response_cache
+from ratelimit import rate_limited, estimate_tokens, EmptyResponse
 import prompts.prompts as prompts
 
 logger = logging.getLogger(__name__)
 
+VISION_MODEL = "gemini-pro-vision"
+
 
 def cornerstone_from_cover(file_path, multimodal_model):
     if file_path is None or file_path == "":
         return
 
-    cover_img = VertextImg.load_from_file(file_path)
+    @rate_limited("gemini")
+    def generate():
+        cover_img = VertextImg.load_from_file(file_path)
+        text = multimodal_model.generate_content(
+            [
+                prompts.CORNERSTONE_PROMPT,
+                cover_img,
+            ]
+        ).text
+        if not text:
+            raise EmptyResponse("empty cornerstone")
+        return text
 
-    cornerstone = multimodal_model.generate_content(
-        [
-            prompts.CORNERSTONE_PROMPT,
-            cover_img,
-        ]
+    cornerstone = response_cache().get_or_call(
+        generate, VISION_MODEL, prompts.CORNERSTONE_PROMPT, images=[file_path]
     )
 
-    logger.info(f"cornerstone: {cornerstone.text}")
+    logger.info(f"cornerstone: {cornerstone}")
+
+    return cornerstone
+
 
-    return cornerstone.text
+def draft_page(multimodal_model, page_transcribe_prompt, fpath, page, cornerstone):
+    """draft a single page, retried on its own without holding up other pages"""
+    descri_img = VertextImg.load_from_file(fpath)
+
+    @rate_limited("gemini")
+    def generate():
+        text = multimodal_model.generate_content(
+            [
+                page_transcribe_prompt,
+                descri_img,
+            ]
+        ).text
+        if not text:
+            raise EmptyResponse(f"empty draft for page {page}")
+        return text
+
+    try:
+        text = response_cache().get_or_call(
+            generate, VISION_MODEL, page_transcribe_prompt, images=[fpath]
+        )
+    except Exception as e:
+        print(e)
+        return None
+    logger.info(f"\npage {page}: {text}")
+    return PageDraft(
+        page=page,
+        cornerstone=cornerstone,
+        draft=text,
+        draft_from_images="",  # extract images and links
+        links=[],
+    )
 
 
-def draft_transcribe(file_paths, document):
+def draft_transcribe(
+    file_paths, document, concurrency=DRAFT_CONCURRENCY, done=None, on_draft=None
+):
     """transcribe the images in the file_paths with gemini-pro-vision
     The first image is the cover of pdf, the title/main idea of the pdf will be generated
     based on the first image.
@@ -54,117 +115,419 @@ def draft_transcribe(file_paths, document):
 
     Args:
         document:
-        file_paths (list(str)): list of file paths of the images
+        file_paths (list(str)): list of file paths of the images, ordered by page
+        concurrency (int): max pages drafted at the same time
+        done (dict(int, PageDraft)): pages already drafted, these are not redone
+        on_draft (callable): called with each new PageDraft as soon as it is done
     Return:
-        list: list of page draft
+        list: list of page draft, pages that failed every retry are left out
     """
     if file_paths is None or len(file_paths) == 0:
         return []
 
+    done = dict(done or {})
     vertexai.init(project=PROJECT_ID, location=LOC)
-    multimodal_model = GenerativeModel("gemini-pro-vision")
+    multimodal_model = GenerativeModel(VISION_MODEL)
 
-    retries = 0
-    cornerstone = None
-    while retries < 3:
-        # fetch cornerstone
+    if 1 in done:
+        cornerstone = done[1].cornerstone
+    else:
+        # fetch cornerstone, retried with backoff by the rate limiter
         try:
             cornerstone = cornerstone_from_cover(file_paths[0], multimodal_model)
-            if cornerstone != "":
-                break
         except Exception as e:
-            print(e)
-            retries += 1
-
-    if not cornerstone:
-        raise Exception("Failed to generate cornerstone")
+            raise Exception(f"Failed to generate cornerstone: {e}")
 
-    page_transcribe_prompt = prompts.PAGE_TRANSCRIBE_PROMPT.format(
-        cornerstone_idea=cornerstone
-    )
-    logger.info(f"page_transcribe_prompt: {page_transcribe_prompt}")
-    page_drafts = []
-    for i, fpath in enumerate(file_paths[1:]):
-        # Get the directory of the current file
-        retries = 0
-        descri_img = VertextImg.load_from_file(fpath)
-        print(descri_img)
-        while retries < 3:
-            try:
-                response = multimodal_model.generate_content(
-                    [
-                        page_transcribe_prompt,
-                        descri_img,
-                    ]
-                )
-                logger.info(f"\npage {i + 1}: {response.text}")
-                draft = PageDraft(
-                    page=i + 2,
-                    cornerstone=cornerstone,
-                    draft=response.text,
-                    draft_from_images="",  # extract images and links
-                    links=[],
-                )
-                if response.text != "":
-                    page_drafts.append(draft)
-                    if document:
-                        document.progress = f"{i + 1}:{len(file_paths)}"
-                        document.save()
-                    break
-            except Exception as e:
-                print(e)
-                retries += 1
-    print(cornerstone)
-    print(type(cornerstone))
-    page_drafts.insert(
-        0,
-        PageDraft(
+        done[1] = PageDraft(
             page=1,
             cornerstone=cornerstone,
             draft=cornerstone,
             draft_from_images="",
             links=[],
-        ),
+        )
+        if on_draft:
+            on_draft(done[1])
+
+    page_transcribe_prompt = prompts.PAGE_TRANSCRIBE_PROMPT.format(
+        cornerstone_idea=cornerstone
     )
-    return page_drafts
+    logger.info(f"page_transcribe_prompt: {page_transcribe_prompt}")
 
+    # pages only depend on the cornerstone, draft the missing ones concurrently
+    missing = [page for page in range(2, len(file_paths) + 1) if page not in done]
+    progress_lock = threading.Lock()
+    completed = len(file_paths) - 1 - len(missing)
 
-def gen_transcript(drafts: List[PageDraft]) -> str:
-    speeches = []
-    llm_cli = llm_client()
-    prev_speech = ""
-    for i, draft in enumerate(drafts):
-        backward_ref = ""
-        forward_ref = ""
-        if i > 0:
-            backward_ref = drafts[i - 1].draft
-        if i < len(drafts) - 1:
-            forward_ref = drafts[i + 1].draft
-
-        # gen transcript based on backward/forward ref and cornerstone
-        sys_prompt, _ = prompts.load_prompt(
-            {
-                "backward_ref": backward_ref,
-                "forward_ref": forward_ref,
-                "cornerstone": draft.cornerstone,
-                "current_page": draft.draft,
-                "speech_from_last_page": prev_speech,
-            },
-            "gen_speech.txt",
+    def draft(page):
+        nonlocal completed
+        page_draft = draft_page(
+            multimodal_model,
+            page_transcribe_prompt,
+            file_paths[page - 1],
+            page,
+            cornerstone,
         )
-        logger.info(f"-----{sys_prompt}")
+        if not page_draft:
+            return
+        with progress_lock:
+            done[page] = page_draft
+            if on_draft:
+                on_draft(page_draft)
+            completed += 1
+            if document:
+                document.progress = f"{completed}:{len(file_paths)}"
+                document.save()
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        list(executor.map(draft, missing))
+
+    return [done[page] for page in sorted(done)]
+
+
+class CallStats:
+    """token usage and latency of the chat calls made for one transcript"""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, usage, seconds):
+        with self.lock:
+            self.calls += 1
+            self.seconds += seconds
+            if usage:
+                self.prompt_tokens += usage.prompt_tokens
+                self.completion_tokens += usage.completion_tokens
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "seconds": round(self.seconds, 2),
+        }
+
+
+def chat_completion(sys_prompt, stats=None, validate=None):
+    """
+    single system prompt chat call, cached and rate limited.
+    An answer for which validate(answer) raises is raised, not cached.
+    """
+    llm_cli = llm_client()
+    model = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+
+    @rate_limited("azure_openai", tokens=lambda: estimate_tokens(sys_prompt))
+    def generate():
+        start = time.perf_counter()
         response = llm_cli.chat.completions.create(
-            model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+            model=model,
             messages=[{"role": "system", "content": sys_prompt}],
         )
+        if stats:
+            stats.record(response.usage, time.perf_counter() - start)
         logger.info(response)
-        new_speech = response.choices[0].message.content
+        return response.choices[0].message.content
+
+    return response_cache().get_or_call(generate, model, sys_prompt, validate=validate)
+
+
+def page_refs(drafts: List[PageDraft], i):
+    """drafts of the pages before and after page index i"""
+    backward_ref = drafts[i - 1].draft if i > 0 else ""
+    forward_ref = drafts[i + 1].draft if i < len(drafts) - 1 else ""
+    return backward_ref, forward_ref
+
+
+def gen_transcript(
+    drafts: List[PageDraft], speeches=None, on_speech=None, mode=TRANSCRIPT_MODE
+) -> str:
+    """
+    Write the speech of every page. `speeches` holds the speeches of pages
+    done in an earlier run (None for a missing page), those are kept.
+    on_speech is called with the list of speeches as pages are written.
+    mode is one of
+      sequential: one call per page, each sees the speech of the page before
+      parallel: see gen_transcript_parallel
+      batched: see gen_transcript_batched
+    Token usage and latency of the run are logged per mode.
+    """
+    stats = CallStats()
+    start = time.perf_counter()
+    if mode == "parallel":
+        speeches = gen_transcript_parallel(drafts, speeches, on_speech, stats)
+    elif mode == "batched":
+        speeches = gen_transcript_batched(drafts, speeches, on_speech, stats)
+    else:
+        speeches = gen_transcript_sequential(drafts, speeches, on_speech, stats)
+    logger.info(
+        f"transcript mode={mode} pages={len(drafts)} "
+        f"wall={time.perf_counter() - start:.2f}s {stats.as_dict()}"
+    )
+    return json.dumps(speeches)
+
+
+def completed_prefix(speeches):
+    """speeches up to the first missing page"""
+    speeches = list(speeches or [])
+    if None in speeches:
+        speeches = speeches[: speeches.index(None)]
+    return speeches
+
+
+def page_inputs(drafts: List[PageDraft], i, prev_speech):
+    """everything the speech of page index i is generated from"""
+    backward_ref, forward_ref = page_refs(drafts, i)
+    return {
+        "backward_ref": backward_ref,
+        "forward_ref": forward_ref,
+        "cornerstone": drafts[i].cornerstone,
+        "current_page": drafts[i].draft,
+        "speech_from_last_page": prev_speech,
+    }
+
+
+def input_hash(inputs):
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def speech_input_hashes(drafts: List[PageDraft], speeches):
+    """input hash of every page given the current drafts and speeches"""
+    return [
+        input_hash(page_inputs(drafts, i, speeches[i - 1] if i > 0 else ""))
+        for i in range(len(drafts))
+    ]
+
+
+def write_page(drafts: List[PageDraft], i, prev_speech, stats=None):
+    # gen transcript based on backward/forward ref and cornerstone
+    sys_prompt, _ = prompts.load_prompt(
+        page_inputs(drafts, i, prev_speech), "gen_speech.txt"
+    )
+    logger.info(f"-----{sys_prompt}")
+    return chat_completion(sys_prompt, stats)
+
+
+def regenerate_pages(drafts: List[PageDraft], speeches, hashes, pages):
+    """
+    Regenerate the speeches of page indexes `pages` (in order) whose inputs
+    changed since they were generated. `hashes` are the input hashes recorded
+    at generation time, a page whose current input hash matches is skipped.
+
+    Returns:
+        (speeches, hashes, list of regenerated page indexes)
+    """
+    speeches = list(speeches)
+    hashes = list(hashes or [])
+    hashes += [None] * (len(drafts) - len(hashes))
+    regenerated = []
+    for i in sorted(pages):
+        if i < 0 or i >= len(drafts):
+            continue
+        prev_speech = speeches[i - 1] if i > 0 else ""
+        current = input_hash(page_inputs(drafts, i, prev_speech))
+        if current == hashes[i]:
+            continue
+        speeches[i] = write_page(drafts, i, prev_speech)
+        hashes[i] = current
+        regenerated.append(i)
+    return speeches, hashes, regenerated
+
+
+def gen_transcript_sequential(drafts: List[PageDraft], speeches, on_speech, stats):
+    # continue after the first missing page
+    speeches = completed_prefix(speeches)
+    prev_speech = speeches[-1] if speeches else ""
+    for i in range(len(speeches), len(drafts)):
+        new_speech = write_page(drafts, i, prev_speech, stats)
 
         # Check if the new speech is not repeating the old speech content
         prev_speech = new_speech
         speeches.append(new_speech)
+        if on_speech:
+            on_speech(speeches)
 
-    return json.dumps(speeches)
+    return speeches
+
+
+def plan_batch(drafts: List[PageDraft], start, token_budget, max_pages):
+    """
+    Page indexes from `start` that fit in one request: the cornerstone and
+    neighbour drafts are counted once, then every page costs its draft plus
+    the expected length of its speech. Always at least one page.
+    """
+    used = estimate_tokens(drafts[start].cornerstone, completion=0)
+    used += sum(estimate_tokens(ref, completion=0) for ref in page_refs(drafts, start))
+    pages = []
+    for i in range(start, min(len(drafts), start + max_pages)):
+        cost = estimate_tokens(drafts[i].draft, completion=TRANSCRIPT_SPEECH_TOKENS)
+        if pages and used + cost > token_budget:
+            break
+        used += cost
+        pages.append(i)
+    return pages
+
+
+def write_batch(drafts: List[PageDraft], pages, prev_speech, stats):
+    """
+    Speeches for consecutive page indexes `pages` from one request. A failed
+    or malformed answer is split in half and each half retried, down to one
+    page per call.
+    """
+    if len(pages) == 1:
+        return [write_page(drafts, pages[0], prev_speech, stats)]
+
+    backward_ref, _ = page_refs(drafts, pages[0])
+    _, forward_ref = page_refs(drafts, pages[-1])
+    sys_prompt, _ = prompts.load_prompt(
+        {
+            "cornerstone": drafts[pages[0]].cornerstone,
+            "backward_ref": backward_ref,
+            "forward_ref": forward_ref,
+            "pages": [
+                {"page": drafts[i].page, "draft": drafts[i].draft} for i in pages
+            ],
+            "speech_from_last_page": prev_speech,
+        },
+        "gen_speech_batch.txt",
+    )
+    try:
+        content = chat_completion(
+            sys_prompt, stats, validate=lambda c: parse_json_list(c, len(pages))
+        )
+        return parse_json_list(content, len(pages))
+    except Exception as e:
+        print(f"batch of pages {pages} failed, splitting: {e}")
+    half = len(pages) // 2
+    first = write_batch(drafts, pages[:half], prev_speech, stats)
+    return first + write_batch(drafts, pages[half:], first[-1], stats)
+
+
+def gen_transcript_batched(
+    drafts: List[PageDraft],
+    speeches,
+    on_speech,
+    stats,
+    token_budget=TRANSCRIPT_BATCH_TOKENS,
+    max_pages=TRANSCRIPT_BATCH_MAX_PAGES,
+):
+    """
+    Consecutive pages are packed into one request as long as they fit in
+    `token_budget`, the model answers with a JSON array of speeches. The
+    cornerstone and the previous speech are sent once per batch instead of
+    once per page.
+    """
+    speeches = completed_prefix(speeches)
+    while len(speeches) < len(drafts):
+        pages = plan_batch(drafts, len(speeches), token_budget, max_pages)
+        prev_speech = speeches[-1] if speeches else ""
+        speeches.extend(write_batch(drafts, pages, prev_speech, stats))
+        if on_speech:
+            on_speech(speeches)
+    return speeches
+
+
+def gen_transcript_parallel(
+    drafts: List[PageDraft],
+    speeches,
+    on_speech,
+    stats,
+    concurrency=TRANSCRIPT_CONCURRENCY,
+    smooth_batch_size=SMOOTH_BATCH_SIZE,
+):
+    """
+    Wavefront mode: every page only needs the drafts around it, so all page
+    speeches are written concurrently, then one smoothing pass rewrites the
+    opening of each speech to follow the previous one. Costs about two round
+    trips instead of one per page.
+    """
+    speeches = list(speeches or [])
+    speeches += [None] * (len(drafts) - len(speeches))
+    lock = threading.Lock()
+
+    def write(i):
+        backward_ref, forward_ref = page_refs(drafts, i)
+        sys_prompt, _ = prompts.load_prompt(
+            {
+                "backward_ref": backward_ref,
+                "forward_ref": forward_ref,
+                "cornerstone": drafts[i].cornerstone,
+                "current_page": drafts[i].draft,
+            },
+            "gen_speech_parallel.txt",
+        )
+        speech = chat_completion(sys_prompt, stats)
+        with lock:
+            speeches[i] = speech
+            if on_speech:
+                on_speech(speeches)
+
+    missing = [i for i, speech in enumerate(speeches) if not speech]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        list(executor.map(write, missing))
+
+    if smooth_batch_size > 0:
+        speeches = smooth_transitions(speeches, smooth_batch_size, stats, concurrency)
+    return speeches
+
+
+def smooth_transitions(
+    speeches, batch_size, stats=None, concurrency=TRANSCRIPT_CONCURRENCY
+):
+    """
+    Rewrite the opening of speeches[1:] to follow on from the speech before,
+    `batch_size` transitions per request. A batch whose answer can not be
+    parsed keeps its original speeches.
+    """
+    transitions = list(range(1, len(speeches)))
+    batches = [
+        transitions[i : i + batch_size] for i in range(0, len(transitions), batch_size)
+    ]
+
+    def smooth(batch):
+        # compare against the unsmoothed previous speech, batches run concurrently
+        sys_prompt, _ = prompts.load_prompt(
+            {
+                "pairs": [
+                    {"previous": speeches[i - 1], "current": speeches[i]} for i in batch
+                ]
+            },
+            "smooth_speech.txt",
+        )
+        try:
+            content = chat_completion(
+                sys_prompt, stats, validate=lambda c: parse_json_list(c, len(batch))
+            )
+            revised = parse_json_list(content, len(batch))
+        except Exception as e:
+            print(f"failed to smooth pages {batch}: {e}")
+            return {}
+        return dict(zip(batch, revised))
+
+    smoothed = list(speeches)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for revised in executor.map(smooth, batches):
+            for i, speech in revised.items():
+                smoothed[i] = speech
+    return smoothed
+
+
+def parse_json_list(content, length):
+    """parse a model answer that should be a JSON array of `length` strings"""
+    content = content.strip()
+    # models like to wrap json in a markdown fence
+    if content.startswith("```"):
+        content = content.split("\n", 1)[1].rsplit("```", 1)[0]
+    items = json.loads(content)
+    if not isinstance(items, list) or len(items) != length:
+        raise ValueError(f"expected a list of {length} items")
+    if not all(isinstance(item, str) and item for item in items):
+        raise ValueError("expected non empty strings")
+    return items
 
 
 # if __name__ == "__main__":
@@ -1,4 +1,11 @@
+import hashlib
+import json
 import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
 
 import azure.cognitiveservices.speech as speechsdk
 import torch
@@ -8,6 +15,28 @@ from transformers.utils import is_flash_attn_2_available
 
 import prompts.prompts as prompts
 from llm import llm_client
+from response_cache import response_cache
+from ratelimit import rate_limited, estimate_tokens
+from artifacts import link_file
+from common import prune_lru, touch
+from config import (
+    TTS_CONCURRENCY,
+    TTS_AUDIO_FORMAT,
+    AUDIO_STORE_DIR,
+    AUDIO_STORE_MAX_BYTES,
+    SUBTITLE_MAX_CHARS,
+    WHISPER_MODEL,
+    WHISPER_DEVICE,
+    WHISPER_QUANTIZE,
+    WHISPER_BATCH_SIZE,
+)
+
+# audio format -> (SpeechSynthesisOutputFormat member, file extension)
+AUDIO_FORMATS = {
+    "wav": ("Riff24Khz16BitMonoPcm", "wav"),
+    "mp3": ("Audio24Khz96KBitRateMonoMp3", "mp3"),
+    "opus": ("Ogg24Khz16BitMonoOpus", "ogg"),
+}
 
 
 def text_to_ssml(text):
@@ -20,56 +49,169 @@ def text_to_ssml(text):
     print(sys_prompt)
     print("----------------")
     llm_cli = llm_client()
-    response = llm_cli.chat.completions.create(
-        model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
-        messages=[{"role": "system", "content": sys_prompt}],
-    )
+    model = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+
+    @rate_limited("azure_openai", tokens=lambda: estimate_tokens(sys_prompt))
+    def generate():
+        response = llm_cli.chat.completions.create(
+            model=model,
+            messages=[{"role": "system", "content": sys_prompt}],
+        )
+        print(response)
+        return response.choices[0].message.content
+
+    return response_cache().get_or_call(generate, model, sys_prompt)
+
+
+class SynthesizerPool:
+    """
+    Reusable SpeechSynthesizers for one voice. A synthesizer keeps its service
+    connection open between pages, so only the first page of a worker pays
+    for the config, the handshake and the connection.
+    """
+
+    def __init__(self, voice_name, size):
+        load_dotenv()
+        # This example requires environment variables named "SPEECH_KEY" and "SPEECH_REGION"
+        self.speech_config = speechsdk.SpeechConfig(
+            subscription=os.environ.get("AZURE_SPEECH_KEY"),
+            region=os.environ.get("AZURE_SPEECH_REGION"),
+        )
+        # Required for WordBoundary event sentences.
+        self.speech_config.set_property(
+            property_id=speechsdk.PropertyId.SpeechServiceResponse_RequestSentenceBoundary,
+            value="true",
+        )
+        self.speech_config.speech_synthesis_voice_name = voice_name
+        # compressed formats come back encoded, nothing to decode or re-encode here
+        self.speech_config.set_speech_synthesis_output_format(
+            getattr(
+                speechsdk.SpeechSynthesisOutputFormat,
+                AUDIO_FORMATS[TTS_AUDIO_FORMAT][0],
+            )
+        )
+        self.size = size
+        self.created = 0
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    def _create(self):
+        # audio_config = speechsdk.audio.AudioOutputConfig(use_default_speaker=True)
+        synthesizer = speechsdk.SpeechSynthesizer(
+            speech_config=self.speech_config, audio_config=None
+        )
+        try:
+            # open the connection now instead of on the first request
+            speechsdk.Connection.from_speech_synthesizer(synthesizer).open(True)
+        except Exception as e:
+            print(f"Error pre-connecting synthesizer: {e}")
+        return synthesizer
+
+    @contextmanager
+    def synthesizer(self):
+        """borrow a synthesizer, blocks while `size` are in use"""
+        with self.lock:
+            create = self.idle.empty() and self.created < self.size
+            if create:
+                self.created += 1
+        synthesizer = self._create() if create else self.idle.get()
+        try:
+            yield synthesizer
+        finally:
+            self.idle.put(synthesizer)
+
+
+synthesizer_pools = {}
+synthesizer_pools_lock = threading.Lock()
+
+
+def get_synthesizer_pool(voice_name) -> SynthesizerPool:
+    with synthesizer_pools_lock:
+        if voice_name not in synthesizer_pools:
+            synthesizer_pools[voice_name] = SynthesizerPool(voice_name, TTS_CONCURRENCY)
+        return synthesizer_pools[voice_name]
+
+
+def boundary_type_name(boundary_type):
+    if boundary_type == speechsdk.SpeechSynthesisBoundaryType.Sentence:
+        return "sentence"
+    if boundary_type == speechsdk.SpeechSynthesisBoundaryType.Punctuation:
+        return "punctuation"
+    return "word"
 
-    print(response)
-    return response.choices[0].message.content
 
+class SpeechSynthesisCanceled(Exception):
+    """
+    A canceled synthesis with its cancellation error code. The rate limiter
+    retries it unless the service refused the request itself (key, region
+    or ssml), which another attempt would not change.
+    """
 
+    FATAL_CODES = {
+        speechsdk.CancellationErrorCode.AuthenticationFailure,
+        speechsdk.CancellationErrorCode.Forbidden,
+        speechsdk.CancellationErrorCode.BadRequest,
+    }
+
+    def __init__(self, cancellation_details):
+        self.reason = cancellation_details.reason
+        self.error_code = cancellation_details.error_code
+        self.transient = not (
+            self.reason == speechsdk.CancellationReason.Error
+            and self.error_code in self.FATAL_CODES
+        )
+        super().__init__(
+            f"Speech synthesis canceled ({self.error_code}): "
+            f"{cancellation_details.error_details}"
+        )
+
+
+@rate_limited("azure_speech")
 def speech_synthesize(ssml, pitch_id, sequence, voice_name="en-US-GuyNeural"):
-    load_dotenv()
-    # This example requires environment variables named "SPEECH_KEY" and "SPEECH_REGION"
-    print(os.environ.get("AZURE_SPEECH_REGION"))
-    print(os.environ.get("AZURE_SPEECH_KEY"))
-    speech_config = speechsdk.SpeechConfig(
-        subscription=os.environ.get("AZURE_SPEECH_KEY"),
-        region=os.environ.get("AZURE_SPEECH_REGION"),
-    )
+    """
+    write media/<pitch_id>/<sequence>.<ext>
 
-    # Required for WordBoundary event sentences.
-    speech_config.set_property(
-        property_id=speechsdk.PropertyId.SpeechServiceResponse_RequestSentenceBoundary,
-        value="true",
-    )
-    speech_config.speech_synthesis_voice_name = voice_name
+    Returns:
+        (audio duration in seconds, word/punctuation/sentence boundaries as
+        {"type", "start", "end", "text"} with times in seconds)
+    """
+    boundaries = []
 
-    # audio_config = speechsdk.audio.AudioOutputConfig(use_default_speaker=True)
-    speech_synthesizer = speechsdk.SpeechSynthesizer(
-        speech_config=speech_config, audio_config=None
-    )
-    print("synthesizing audio")
-    # speech_synthesis_result = speech_synthesizer.speak_ssml(ssml)
-    speech_synthesis_result = speech_synthesizer.speak_text(ssml)
+    def on_boundary(evt):
+        # audio offsets are in 100ns ticks
+        start = evt.audio_offset / 10000000
+        boundaries.append(
+            {
+                "type": boundary_type_name(evt.boundary_type),
+                "start": start,
+                "end": start + evt.duration.total_seconds(),
+                "text": evt.text,
+            }
+        )
+
+    with get_synthesizer_pool(voice_name).synthesizer() as speech_synthesizer:
+        speech_synthesizer.synthesis_word_boundary.connect(on_boundary)
+        try:
+            # speech_synthesis_result = speech_synthesizer.speak_ssml(ssml)
+            speech_synthesis_result = speech_synthesizer.speak_text(ssml)
+        finally:
+            # the synthesizer goes back to the pool
+            speech_synthesizer.synthesis_word_boundary.disconnect_all()
 
     if (
         speech_synthesis_result.reason
         == speechsdk.ResultReason.SynthesizingAudioCompleted
     ):
         print("SynthesizingAudioCompleted result")
-        stream = speechsdk.AudioDataStream(speech_synthesis_result)
-        # creat a tmp file to store the audio
         os.makedirs(
             os.path.abspath(os.path.join("media", str(pitch_id))), exist_ok=True
         )
-        output_audio = os.path.abspath(
-            os.path.join("media", str(pitch_id), str(sequence) + ".wav")
-        )
+        output_audio = page_audio_path(pitch_id, sequence)
         print(f"output audio: {output_audio}")
-        stream.save_to_wav_file(output_audio)
-        return True
+        # audio_data is the complete file in the configured output format
+        with open(output_audio, "wb") as f:
+            f.write(speech_synthesis_result.audio_data)
+        return speech_synthesis_result.audio_duration.total_seconds(), boundaries
     elif speech_synthesis_result.reason == speechsdk.ResultReason.Canceled:
         cancellation_details = speech_synthesis_result.cancellation_details
         print("Speech synthesis canceled: {}".format(cancellation_details.reason))
@@ -77,7 +219,138 @@ def speech_synthesize(ssml, pitch_id, sequence, voice_name="en-US-GuyNeural"):
             if cancellation_details.error_details:
                 print("Error details: {}".format(cancellation_details.error_details))
                 print("Did you set the speech resource key and region values?")
-        return False
+        raise SpeechSynthesisCanceled(cancellation_details)
+
+
+def audio_extension(fmt=TTS_AUDIO_FORMAT):
+    return AUDIO_FORMATS[fmt][1]
+
+
+def page_audio_path(pitch_id, sequence):
+    return os.path.abspath(
+        os.path.join("media", str(pitch_id), f"{sequence}.{audio_extension()}")
+    )
+
+
+def audio_key(text, voice_name):
+    """content address of a page's audio: its text, voice and synthesis settings"""
+    payload = json.dumps(
+        {
+            "text": text,
+            "voice": voice_name,
+            "format": AUDIO_FORMATS[TTS_AUDIO_FORMAT][0],
+            "sentence_boundary": True,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def page_subtitle_path(pitch_id, sequence, ext):
+    return os.path.abspath(os.path.join("media", str(pitch_id), f"{sequence}.{ext}"))
+
+
+def subtitle_cues(boundaries, max_chars=SUBTITLE_MAX_CHARS):
+    """
+    Subtitle cues from synthesis boundaries: words are grouped per sentence
+    into cues of at most `max_chars` characters, each timed from its first
+    word's start to its last word's end.
+    """
+    words = sorted(
+        (b for b in boundaries if b["type"] != "sentence"), key=lambda b: b["start"]
+    )
+    sentence_ends = sorted(b["end"] for b in boundaries if b["type"] == "sentence")
+    cues = []
+    cue = None
+    sentence = 0
+    for word in words:
+        # a cue never spans two sentences
+        new_sentence = False
+        while (
+            sentence < len(sentence_ends) - 1
+            and word["start"] >= sentence_ends[sentence]
+        ):
+            sentence += 1
+            new_sentence = True
+        punctuation = word["type"] == "punctuation"
+        too_long = (
+            cue is not None
+            and not punctuation
+            and len(cue["text"]) + 1 + len(word["text"]) > max_chars
+        )
+        if cue is not None and (new_sentence or too_long):
+            cues.append(cue)
+            cue = None
+        if cue is None:
+            cue = {"start": word["start"], "end": word["end"], "text": word["text"]}
+            continue
+        cue["text"] += word["text"] if punctuation else " " + word["text"]
+        cue["end"] = max(cue["end"], word["end"])
+    if cue is not None:
+        cues.append(cue)
+    return cues
+
+
+def write_subtitles(cues, pitch_id, sequence):
+    """media/<pitch_id>/<sequence>.srt and .vtt next to the page audio"""
+    with open(page_subtitle_path(pitch_id, sequence, "srt"), "w") as srt_file:
+        for index, cue in enumerate(cues, start=1):
+            srt_file.write(f"{index}\n")
+            srt_file.write(
+                f"{format_srt_time(cue['start'])} --> {format_srt_time(cue['end'])}\n"
+            )
+            srt_file.write(f"{cue['text']}\n\n")
+    with open(page_subtitle_path(pitch_id, sequence, "vtt"), "w") as vtt_file:
+        vtt_file.write("WEBVTT\n\n")
+        for cue in cues:
+            vtt_file.write(
+                f"{format_vtt_time(cue['start'])} --> {format_vtt_time(cue['end'])}\n"
+            )
+            vtt_file.write(f"{cue['text']}\n\n")
+
+
+def synthesize_page(text, pitch_id, sequence, voice_name="en-US-GuyNeural"):
+    """
+    Write the audio and subtitles of one page, reusing the audio store entry
+    for identical text and settings when there is one. The duration and
+    subtitle cues from the speech service are kept next to the stored audio,
+    so hits never decode it and subtitles never need a transcription pass.
+
+    Returns:
+        (duration in seconds, True if the audio was reused)
+    """
+    os.makedirs(AUDIO_STORE_DIR, exist_ok=True)
+    key = audio_key(text, voice_name)
+    stored = os.path.join(AUDIO_STORE_DIR, f"{key}.{audio_extension()}")
+    stored_meta = os.path.join(AUDIO_STORE_DIR, f"{key}.json")
+    output_audio = page_audio_path(pitch_id, sequence)
+    meta = None
+    if os.path.exists(stored) and os.path.exists(stored_meta):
+        with open(stored_meta, "r") as f:
+            meta = json.load(f)
+    # entries stored before subtitles were kept are synthesized again
+    if meta is not None and "cues" in meta:
+        touch(stored)
+        touch(stored_meta)
+        os.makedirs(os.path.dirname(output_audio), exist_ok=True)
+        link_file(stored, output_audio)
+        write_subtitles(meta["cues"], pitch_id, sequence)
+        return meta["duration"], True
+    duration, boundaries = speech_synthesize(text, pitch_id, sequence, voice_name)
+    cues = subtitle_cues(boundaries)
+    write_subtitles(cues, pitch_id, sequence)
+    link_file(output_audio, stored)
+    # readers of the store must never see a partial file
+    tmp_meta = f"{stored_meta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_meta, "w") as f:
+        json.dump({"duration": duration, "cues": cues}, f)
+    os.replace(tmp_meta, stored_meta)
+    return duration, False
+
+
+def prune_audio_store():
+    prune_lru(AUDIO_STORE_DIR, AUDIO_STORE_MAX_BYTES)
 
 
 # insanely fast whisper
@@ -102,49 +375,140 @@ def format_srt_time(seconds):
         return "00:00:00,000"
 
 
-def srt_from_whisper(pitch_id):
-    pitch_id = str(pitch_id)
-    audio_files = os.listdir(os.path.abspath(os.path.join("media", pitch_id)))
-    device = "cuda:0" if torch.cuda.is_available() else os.getenv("DEVICE", "mps")
-    pipe = pipeline(
-        "automatic-speech-recognition",
-        model="openai/whisper-large-v3",
-        # select checkpoint from https://huggingface.co/openai/whisper-large-v3#model-details
-        torch_dtype=torch.float16,
-        device=device,  # or mps for Mac devices
-        model_kwargs={"attn_implementation": "flash_attention_2"}
-        if is_flash_attn_2_available()
-        else {"attn_implementation": "sdpa"},
-    )
-    for audio_file in audio_files:
-        if audio_file.endswith(".wav"):
-            srt_file_path = os.path.abspath(
-                os.path.join("media", pitch_id, audio_file.replace(".wav", ".srt"))
+def format_vtt_time(seconds):
+    """WebVTT uses a dot before the milliseconds"""
+    return format_srt_time(seconds).replace(",", ".")
+
+
+whisper_pipeline = None
+whisper_pipeline_lock = threading.Lock()
+
+
+def whisper_device():
+    if WHISPER_DEVICE:
+        return WHISPER_DEVICE
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def get_whisper_pipeline():
+    """
+    The whisper pipeline of this process, loaded on first use and kept warm.
+    On cpu the linear layers are quantized to int8 (WHISPER_QUANTIZE), which
+    is where nearly all of whisper's compute is.
+    """
+    global whisper_pipeline
+    with whisper_pipeline_lock:
+        if whisper_pipeline is None:
+            device = whisper_device()
+            on_cpu = device == "cpu"
+            if device.startswith("cuda") and is_flash_attn_2_available():
+                attn_implementation = "flash_attention_2"
+            else:
+                attn_implementation = "sdpa"
+            pipe = pipeline(
+                "automatic-speech-recognition",
+                model=WHISPER_MODEL,
+                # select checkpoint from https://huggingface.co/openai/whisper-large-v3#model-details
+                torch_dtype=torch.float32 if on_cpu else torch.float16,
+                device=device,
+                model_kwargs={"attn_implementation": attn_implementation},
             )
-            with open(srt_file_path, "w") as srt_file:
-                audio_file_path = os.path.abspath(
-                    os.path.join("media", pitch_id, audio_file)
-                )
-                outputs = pipe(
-                    audio_file_path,
-                    chunk_length_s=30,
-                    batch_size=24,
-                    return_timestamps=True,
+            if on_cpu and WHISPER_QUANTIZE:
+                pipe.model = torch.quantization.quantize_dynamic(
+                    pipe.model, {torch.nn.Linear}, dtype=torch.qint8
                 )
-                print(f"whisper outputs: {outputs}")
-                # Iterate over each chunk in the transcript
-                for index, chunk in enumerate(outputs["chunks"], start=1):
-                    start_time = format_srt_time(chunk["timestamp"][0])
-                    end_time = format_srt_time(chunk["timestamp"][1])
-                    text = chunk["text"].replace("\n", " ")
+            whisper_pipeline = pipe
+        return whisper_pipeline
+
+
+def srt_up_to_date(audio_path, srt_path):
+    return os.path.exists(srt_path) and os.path.getmtime(srt_path) >= os.path.getmtime(
+        audio_path
+    )
+
+
+def write_whisper_srt(srt_path, chunks):
+    with open(srt_path, "w") as srt_file:
+        # Iterate over each chunk in the transcript
+        for index, chunk in enumerate(chunks, start=1):
+            start, end = chunk["timestamp"]
+            # the last chunk of a file can come back without an end
+            start_time = format_srt_time(start)
+            end_time = format_srt_time(end if end is not None else start)
+            text = chunk["text"].replace("\n", " ").strip()
+
+            # Write the SRT format to the file
+            srt_file.write(f"{index}\n")
+            srt_file.write(f"{start_time} --> {end_time}\n")
+            srt_file.write(f"{text}\n\n")
+
+
+def transcribe_audio(audio_paths):
+    """whisper chunks of every file, all files go through one batched call"""
+    outputs = get_whisper_pipeline()(
+        list(audio_paths),
+        chunk_length_s=30,
+        batch_size=WHISPER_BATCH_SIZE,
+        return_timestamps=True,
+    )
+    return [output["chunks"] for output in outputs]
+
+
+def srt_from_whisper(pitch_id, force=False):
+    """
+    Subtitles for page audio we did not synthesize (pages synthesized here get
+    theirs from the boundary events). Pages whose .srt is newer than their
+    audio are skipped unless `force`.
 
-                    # Write the SRT format to the file
-                    srt_file.write(f"{index}\n")
-                    srt_file.write(f"{start_time} --> {end_time}\n")
-                    srt_file.write(f"{text}\n\n")
+    Returns:
+        the .srt paths written
+    """
+    folder = os.path.abspath(os.path.join("media", str(pitch_id)))
+    pending = []
+    for audio_file in os.listdir(folder):
+        name, ext = os.path.splitext(audio_file)
+        if ext != f".{audio_extension()}" or not name.isdigit():
+            continue
+        audio_path = os.path.join(folder, audio_file)
+        srt_path = os.path.join(folder, name + ".srt")
+        if force or not srt_up_to_date(audio_path, srt_path):
+            pending.append((int(name), audio_path, srt_path))
+    if not pending:
+        return []
+    pending.sort()
+
+    start = time.perf_counter()
+    chunks = transcribe_audio(audio_path for _, audio_path, _ in pending)
+    print(f"whisper: {len(pending)} pages in {time.perf_counter() - start:.2f}s")
+    for (_, _, srt_path), page_chunks in zip(pending, chunks):
+        write_whisper_srt(srt_path, page_chunks)
+    return [srt_path for _, _, srt_path in pending]
 
 
 if __name__ == "__main__":
-    # ssml = text_to_ssml("hello world")
-    # speech_synthesize(ssml, 1)
-    srt_from_whisper(1)
+    # benchmark: python tts.py <audio file>...
+    # real time factor of the warm whisper pipeline, seconds of compute per
+    # second of audio, WHISPER_DEVICE and WHISPER_QUANTIZE select the backend
+    from raster import peak_rss_mb
+    from video import probe_duration
+
+    files = sys.argv[1:]
+    audio_seconds = sum(probe_duration(path) for path in files)
+
+    start = time.perf_counter()
+    get_whisper_pipeline()
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    transcribe_audio(files)
+    seconds = time.perf_counter() - start
+
+    print(
+        f"{WHISPER_MODEL} on {whisper_device()}, "
+        f"int8: {WHISPER_QUANTIZE and whisper_device() == 'cpu'}"
+    )
+    print(f"load: {load_seconds:.2f}s, peak rss {peak_rss_mb()[0]} MB")
+    print(
+        f"{len(files)} files, {audio_seconds:.1f}s of audio in {seconds:.2f}s, "
+        f"rtf {seconds / audio_seconds:.3f}"
+    )
@@ -0,0 +1,568 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import file_sha256, prune_lru, touch
+from config import (
+    VIDEO_FPS,
+    VIDEO_GOP_SECONDS,
+    VIDEO_CRF,
+    VIDEO_PRESET,
+    VIDEO_AUDIO_BITRATE,
+    VIDEO_FRAME_SIZE,
+    VIDEO_HLS_SEGMENT_SECONDS,
+    HLS_RENDITIONS,
+    SEGMENT_STORE_DIR,
+    SEGMENT_STORE_MAX_BYTES,
+    VIDEO_WORKERS,
+)
+from raster import parse_size, peak_rss_mb
+
+logger = logging.getLogger(__name__)
+
+
+def run_ffmpeg(args):
+    """run ffmpeg quietly, raises with the tail of its log on failure"""
+    command = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", *args]
+    logger.debug(" ".join(command))
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr[-2000:]}")
+
+
+def _concat_entry(path):
+    # concat demuxer quoting: close the quote, escape it, reopen
+    return "file '{}'\n".format(os.path.abspath(path).replace("'", "'\\''"))
+
+
+def write_concat_list(path, files, durations=None):
+    """
+    ffmpeg concat demuxer list. With durations every file (a still image) is
+    shown for that long. The last image is listed twice, otherwise the demuxer
+    ignores its duration.
+    """
+    with open(path, "w") as f:
+        for i, file in enumerate(files):
+            f.write(_concat_entry(file))
+            if durations is not None:
+                f.write(f"duration {durations[i]:.3f}\n")
+        if durations is not None and files:
+            f.write(_concat_entry(files[-1]))
+
+
+def parse_renditions(spec=HLS_RENDITIONS):
+    """
+    'name:WIDTHxHEIGHT:video bitrate:audio bitrate,...' ->
+    {name: (size, video bitrate, audio bitrate)} in ladder order
+    """
+    renditions = {}
+    for entry in spec.split(","):
+        name, size, video_bitrate, audio_bitrate = entry.strip().split(":")
+        renditions[name] = (size, video_bitrate, audio_bitrate)
+    return renditions
+
+
+def bitrate_bps(bitrate):
+    """'1500k' -> 1500000"""
+    bitrate = bitrate.lower()
+    scale = {"k": 1000, "m": 1000000}.get(bitrate[-1], 1)
+    return int(float(bitrate.rstrip("km")) * scale)
+
+
+def video_encode_args(
+    size=VIDEO_FRAME_SIZE, bitrate=None, fps=VIDEO_FPS, gop_seconds=VIDEO_GOP_SECONDS
+):
+    """
+    x264 settings for slides: a still image needs few frames and keyframes.
+    With a bitrate the crf quality is capped to it (vbv), as hls renditions are.
+    """
+    # fmt: off
+    args = [
+        "-c:v", "libx264",
+        "-tune", "stillimage",
+        "-preset", VIDEO_PRESET,
+        "-crf", str(VIDEO_CRF),
+        "-r", str(fps),
+        "-g", str(max(1, int(fps * gop_seconds))),
+        "-pix_fmt", "yuv420p",
+        "-vf", frame_filter(size),
+    ]
+    # fmt: on
+    if bitrate:
+        args += ["-maxrate", bitrate, "-bufsize", str(2 * bitrate_bps(bitrate))]
+    return args
+
+
+def frame_filter(size=VIDEO_FRAME_SIZE):
+    """
+    Fit every slide into the same letterboxed frame, segments can only be
+    joined without re-encoding when they share dimensions.
+    """
+    frame = parse_size(size)
+    if not frame:
+        # x264 needs even dimensions
+        return "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+    width, height = frame
+    return (
+        f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1"
+    )
+
+
+def audio_encode_args(bitrate=VIDEO_AUDIO_BITRATE):
+    return ["-c:a", "aac", "-b:a", bitrate]
+
+
+def build_slideshow(image_paths, audio_paths, durations, output_path):
+    """
+    Encode the slideshow in one ffmpeg run: every slide image is shown for the
+    duration of its page audio, the page audio is joined into one track.
+    Nothing but the two concat lists is written besides the output.
+
+    Args:
+        image_paths: slide image per page, in page order
+        audio_paths: page audio per page, same order and format
+        durations: page audio durations in seconds
+        output_path: mp4 to write
+    """
+    work_folder = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        images_list = os.path.join(work_folder, "images.txt")
+        audio_list = os.path.join(work_folder, "audio.txt")
+        write_concat_list(images_list, image_paths, durations)
+        write_concat_list(audio_list, audio_paths)
+        # fmt: off
+        run_ffmpeg(
+            [
+                "-f", "concat", "-safe", "0", "-i", images_list,
+                "-f", "concat", "-safe", "0", "-i", audio_list,
+                "-map", "0:v", "-map", "1:a",
+                *video_encode_args(),
+                *audio_encode_args(),
+                "-shortest",
+                "-movflags", "+faststart",
+                output_path,
+            ]
+        )
+        # fmt: on
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    return output_path
+
+
+def segment_key(image_path, audio_path, video_args, audio_args):
+    """content address of a slide segment: image, audio and encoder settings"""
+    payload = json.dumps(
+        {
+            "image": file_sha256(image_path),
+            "audio": file_sha256(audio_path),
+            "video": video_args,
+            "audio_encode": audio_args,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def encode_segment(
+    image_path, audio_path, duration, output_path, video_args, audio_args, threads=0
+):
+    """
+    Encode one slide as a self contained mp4: the image held for `duration`
+    seconds over its page audio. Every segment starts on a keyframe.
+    `threads` caps the encoder threads, 0 lets x264 use every core.
+    """
+    tmp = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp.mp4"
+    try:
+        # fmt: off
+        run_ffmpeg(
+            [
+                "-loop", "1", "-framerate", str(VIDEO_FPS), "-i", image_path,
+                "-i", audio_path,
+                "-map", "0:v", "-map", "1:a",
+                "-t", f"{duration:.3f}",
+                *video_args,
+                *audio_args,
+                "-threads", str(threads),
+                tmp,
+            ]
+        )
+        # fmt: on
+        os.replace(tmp, output_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return output_path
+
+
+def slide_segment(
+    image_path,
+    audio_path,
+    duration,
+    video_args,
+    audio_args,
+    store=SEGMENT_STORE_DIR,
+    threads=0,
+):
+    """
+    Segment for one slide from the segment store, encoded only when no
+    segment exists for this image, audio and settings.
+
+    Returns:
+        (segment path, True if it was reused)
+    """
+    os.makedirs(store, exist_ok=True)
+    key = segment_key(image_path, audio_path, video_args, audio_args)
+    segment = os.path.join(store, f"{key}.mp4")
+    if os.path.exists(segment):
+        touch(segment)
+        return segment, True
+    encode_segment(
+        image_path, audio_path, duration, segment, video_args, audio_args, threads
+    )
+    return segment, False
+
+
+def encode_threads(workers=VIDEO_WORKERS):
+    """x264 threads per encode when `workers` encodes share the machine"""
+    return max(1, (os.cpu_count() or 1) // workers) if workers > 1 else 0
+
+
+def encode_segments(jobs, workers=VIDEO_WORKERS, store=SEGMENT_STORE_DIR):
+    """
+    Get the segment of every (image, audio, duration, video args, audio args)
+    job, up to `workers` encoding at once. Each encode is its own ffmpeg
+    process, the threads here only wait on it, and the cores are split
+    between the encoders so they do not oversubscribe the machine.
+
+    Returns:
+        [(segment path, encode seconds, reused)] in job order
+    """
+    workers = max(1, workers)
+    threads = encode_threads(workers)
+
+    def segment(job):
+        start = time.perf_counter()
+        path, reused = slide_segment(*job, store=store, threads=threads)
+        return path, round(time.perf_counter() - start, 2), reused
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(segment, jobs))
+    prune_segment_store(store)
+    return results
+
+
+def prune_segment_store(store=SEGMENT_STORE_DIR):
+    prune_lru(store, SEGMENT_STORE_MAX_BYTES)
+
+
+def clear_hls(folder):
+    """remove a previous hls output, a shorter deck would leave stale segments"""
+    for file in os.listdir(folder):
+        if file.startswith("index") and file.endswith((".m3u8", ".ts")):
+            os.remove(os.path.join(folder, file))
+
+
+def concat_segments(segments, output_args):
+    """join segments in order without re-encoding, `output_args` says where to"""
+    output_folder = os.path.dirname(os.path.abspath(output_args[-1]))
+    work_folder = tempfile.mkdtemp(dir=output_folder)
+    try:
+        segments_list = os.path.join(work_folder, "segments.txt")
+        write_concat_list(segments_list, segments)
+        # fmt: off
+        run_ffmpeg(
+            [
+                "-f", "concat", "-safe", "0", "-i", segments_list,
+                "-c", "copy",
+                *output_args,
+            ]
+        )
+        # fmt: on
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+def build_slideshow_segments(
+    image_paths,
+    audio_paths,
+    durations,
+    output_path,
+    workers=VIDEO_WORKERS,
+    store=SEGMENT_STORE_DIR,
+):
+    """
+    Encode each slide as its own cached segment and join them into one mp4
+    with stream copy, so after an edit only the changed slides are encoded.
+
+    Returns:
+        list of {"page", "seconds", "reused"} per slide
+    """
+    video_args, audio_args = video_encode_args(), audio_encode_args()
+    jobs = [
+        (image_paths[i], audio_paths[i], durations[i], video_args, audio_args)
+        for i in range(len(image_paths))
+    ]
+    segments = encode_segments(jobs, workers, store)
+    # segments are joined in page order whatever order they finished in
+    concat_segments(
+        [path for path, _, _ in segments], ["-movflags", "+faststart", output_path]
+    )
+    return [
+        {"page": i + 1, "seconds": seconds, "reused": reused}
+        for i, (_, seconds, reused) in enumerate(segments)
+    ]
+
+
+def playlist_bandwidth(playlist_path):
+    """
+    (bytes, peak bits/s, average bits/s) of an hls media playlist, measured
+    from its segment files as the master playlist BANDWIDTH wants
+    """
+    folder = os.path.dirname(playlist_path)
+    total_bytes, total_seconds, peak = 0, 0.0, 0
+    duration = None
+    with open(playlist_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:") :].split(",")[0])
+            elif line and not line.startswith("#") and duration:
+                size = os.path.getsize(os.path.join(folder, line))
+                total_bytes += size
+                total_seconds += duration
+                peak = max(peak, int(size * 8 / duration))
+                duration = None
+    average = int(total_bytes * 8 / total_seconds) if total_seconds else 0
+    return total_bytes, peak, average
+
+
+def write_master_playlist(hls_folder, variants):
+    """index.m3u8 listing each (playlist, size, peak bits/s, average bits/s)"""
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for playlist, size, peak, average in variants:
+        attributes = f"BANDWIDTH={peak},AVERAGE-BANDWIDTH={average}"
+        if parse_size(size):
+            attributes += ",RESOLUTION={}x{}".format(*parse_size(size))
+        lines += [f"#EXT-X-STREAM-INF:{attributes}", playlist]
+    master = os.path.join(hls_folder, "index.m3u8")
+    with open(master + ".tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(master + ".tmp", master)
+    return master
+
+
+def rendition_jobs(image_paths, audio_paths, durations, renditions=None):
+    """
+    Segment jobs (image, audio, duration, video args, audio args) of every
+    slide of every rendition, rendition by rendition in ladder order.
+    """
+    renditions = renditions or parse_renditions()
+    jobs = []
+    for size, video_bitrate, audio_bitrate in renditions.values():
+        video_args = video_encode_args(size, video_bitrate)
+        audio_args = audio_encode_args(audio_bitrate)
+        jobs += [
+            (image_paths[i], audio_paths[i], durations[i], video_args, audio_args)
+            for i in range(len(image_paths))
+        ]
+    return jobs
+
+
+def package_hls(segments, pages, hls_folder, renditions=None):
+    """
+    Package the segments of `rendition_jobs` as hls in `hls_folder`:
+    index.m3u8 is the master playlist, each rendition has index_<name>.m3u8
+    and its .ts segments, packaged from its slide segments by stream copy.
+
+    Args:
+        segments: [(segment path, encode seconds, reused)] in job order
+        pages: number of slides
+
+    Returns:
+        {
+            "slides": [{"page", "reused"}] reused when no rendition was encoded,
+            "renditions": {name: {"seconds", "bytes", "bandwidth"}},
+        }
+    """
+    renditions = renditions or parse_renditions()
+    clear_hls(hls_folder)
+    report = {"slides": [], "renditions": {}}
+    variants = []
+    for r, (name, (size, _, _)) in enumerate(renditions.items()):
+        rendition_segments = segments[r * pages : (r + 1) * pages]
+        playlist = os.path.join(hls_folder, f"index_{name}.m3u8")
+        # fmt: off
+        concat_segments(
+            [path for path, _, _ in rendition_segments],
+            [
+                "-f", "hls",
+                "-hls_time", str(VIDEO_HLS_SEGMENT_SECONDS),
+                "-hls_playlist_type", "vod",
+                "-hls_segment_filename",
+                os.path.join(hls_folder, f"index_{name}_%d.ts"),
+                playlist,
+            ],
+        )
+        # fmt: on
+        total_bytes, peak, average = playlist_bandwidth(playlist)
+        variants.append((os.path.basename(playlist), size, peak, average))
+        report["renditions"][name] = {
+            "seconds": round(sum(seconds for _, seconds, _ in rendition_segments), 2),
+            "bytes": total_bytes,
+            "bandwidth": average,
+        }
+    write_master_playlist(hls_folder, variants)
+
+    for i in range(pages):
+        reused = all(segments[r * pages + i][2] for r in range(len(renditions)))
+        report["slides"].append({"page": i + 1, "reused": reused})
+    return report
+
+
+def build_hls(
+    image_paths,
+    audio_paths,
+    durations,
+    hls_folder,
+    renditions=None,
+    workers=VIDEO_WORKERS,
+    store=SEGMENT_STORE_DIR,
+):
+    """
+    Package the slideshow as hls in `hls_folder` within this process.
+    Every slide of every rendition is a cached segment (see encode_segments),
+    no full length video is written in between. Returns the package_hls report.
+    """
+    renditions = renditions or parse_renditions()
+    jobs = rendition_jobs(image_paths, audio_paths, durations, renditions)
+    segments = encode_segments(jobs, workers, store)
+    return package_hls(segments, len(image_paths), hls_folder, renditions)
+
+
+def build_slideshow_moviepy(image_paths, audio_paths, durations, output_path):
+    """
+    The previous slideshow builder: raw 1 fps avi per slide with cv2, audio
+    attached and joined with moviepy, then a full re-encode. Kept to benchmark
+    against. Returns the bytes of temporary files it wrote.
+    """
+    import cv2
+    from moviepy.editor import VideoFileClip, concatenate_videoclips, AudioFileClip
+
+    video_clips = []
+    tmp_paths = []
+    folder = os.path.dirname(os.path.abspath(output_path))
+    for i, img in enumerate(image_paths):
+        tmp_path = os.path.join(folder, f"{i + 1}_temp.avi")
+        tmp_paths.append(tmp_path)
+        audio_clip = AudioFileClip(audio_paths[i])
+        frame = cv2.imread(img)
+        height, width, layers = frame.shape
+        video_clip = cv2.VideoWriter(tmp_path, 0, 1, (width, height))
+        for _ in range(int(durations[i] * 1)):  # 1 fps
+            video_clip.write(frame)
+        video_clip.release()
+        video_clip = VideoFileClip(tmp_path)
+        video_clips.append(video_clip.set_audio(audio_clip))
+
+    final_clip = concatenate_videoclips(video_clips, method="compose")
+    final_clip.write_videofile(output_path, codec="libx264", fps=1, audio_codec="aac")
+    for clip in video_clips:
+        clip.close()
+
+    tmp_bytes = sum(os.path.getsize(path) for path in tmp_paths)
+    for path in tmp_paths:
+        os.remove(path)
+    return tmp_bytes
+
+
+def probe_duration(path):
+    # fmt: off
+    result = subprocess.run(
+        [
+            "ffprobe", "-v", "error",
+            "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            path,
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # fmt: on
+    return float(result.stdout.strip())
+
+
+if __name__ == "__main__":
+    # benchmark: python video.py <builder> <slides folder> <audio folder> [output]
+    # builder: ffmpeg, segments, hls, moviepy,
+    # or scaling for segments at 1/2/4/8 workers
+    # slides are slide_<n>.jpg, audio <n>.<ext> as written by the audio step.
+    # Run once per builder, peak rss of child processes is per process.
+    from raster import slide_paths
+
+    builder, slides_folder, audio_folder = sys.argv[1], sys.argv[2], sys.argv[3]
+    out = sys.argv[4] if len(sys.argv) > 4 else "video_bench"
+    os.makedirs(out, exist_ok=True)
+
+    images = slide_paths(slides_folder)
+    audio = sorted(
+        (
+            os.path.join(audio_folder, file)
+            for file in os.listdir(audio_folder)
+            if os.path.splitext(file)[0].isdigit()
+            and os.path.splitext(file)[1] in (".wav", ".mp3", ".ogg")
+        ),
+        key=lambda path: int(os.path.splitext(os.path.basename(path))[0]),
+    )[: len(images)]
+    lengths = [probe_duration(path) for path in audio]
+
+    output = os.path.join(out, f"{builder}.mp4")
+    start = time.perf_counter()
+    if builder == "moviepy":
+        tmp_bytes = build_slideshow_moviepy(images, audio, lengths, output)
+    elif builder == "segments":
+        # run twice to see the cached cost, or touch a slide in between
+        build_slideshow_segments(images, audio, lengths, output)
+        tmp_bytes = 0
+    elif builder == "hls":
+        report = build_hls(images, audio, lengths, out)
+        for name, rendition in report["renditions"].items():
+            print(
+                f"{name}: encode {rendition['seconds']:.2f}s, "
+                f"{rendition['bytes'] / 1024 / 1024:.1f} MB, "
+                f"{rendition['bandwidth'] / 1000:.0f} kbit/s"
+            )
+        sys.exit(0)
+    elif builder == "scaling":
+        # cold encodes of the whole deck, each worker count with an empty store
+        for workers in (1, 2, 4, 8):
+            store = tempfile.mkdtemp(dir=out)
+            start = time.perf_counter()
+            build_slideshow_segments(
+                images, audio, lengths, output, workers=workers, store=store
+            )
+            seconds = time.perf_counter() - start
+            print(f"{workers} workers: {seconds:.2f}s")
+            shutil.rmtree(store)
+        sys.exit(0)
+    else:
+        build_slideshow(images, audio, lengths, output)
+        tmp_bytes = 0  # only the concat lists
+    seconds = time.perf_counter() - start
+    own, children = peak_rss_mb()
+
+    print(f"slides: {len(images)}, audio: {sum(lengths):.0f}s")
+    print(
+        f"{builder}: {seconds:.2f}s, peak rss {own} MB (ffmpeg {children} MB), "
+        f"temp {tmp_bytes / 1024 / 1024:.1f} MB, "
+        f"output {os.path.getsize(output) / 1024 / 1024:.1f} MB"
+    )